@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+Runs the same rendering workloads through lxmlmeld, a pure lxml baseline
+and (if it is installed) meld3, and reports throughput and memory use as
+JSON.
+
+    python benchmarks/bench.py [--workload NAME] [--implementation NAME]
+        [--iterations N] [--scale F] [--output FILE]
+
+Each workload/implementation pair is run in a separate process, so that
+the peak memory reported is its own. Everything is generated locally;
+nothing is fetched.
+"""
+
+import argparse
+import datetime
+import importlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+if __package__ in (None, ""):
+    # Run as a script: use the lxmlmeld in this tree
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__
+    ))))
+
+from lxml import etree  # noqa: E402
+
+DOCTYPE = '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN" ' \
+    '"http://www.w3.org/TR/html4/loose.dtd">'
+
+PAGE = """<html><head><title meld:id="title">Title</title></head><body>
+<h1 meld:id="heading">Heading</h1>
+<div meld:id="intro">Intro</div>
+<p meld:id="updated">Yesterday</p>
+<div meld:id="content">Content</div>
+<p meld:id="footer">Footer</p>
+</body></html>"""
+
+TABLE = """<html><head><title>Table</title></head><body>
+<table><tr><th>Id</th><th>Name</th><th>Value</th></tr>
+<tr meld:id="row"><td meld:id="id">0</td><td meld:id="name">Name</td>
+<td meld:id="value">0.0</td></tr></table>
+</body></html>"""
+
+NESTED = """<html><head><title>Groups</title></head><body>
+<div meld:id="group"><h2 meld:id="group_name">Group</h2>
+<ul><li meld:id="item"><span meld:id="item_name">Item</span>
+<span meld:id="item_count">0</span></li></ul></div>
+</body></html>"""
+
+POSTS = """<html><head><title>Posts</title></head><body>
+<div meld:id="post"><h2 meld:id="post_title">Title</h2>
+<div meld:id="post_body">Body</div></div>
+</body></html>"""
+
+POST_BODY = "<p>Post number {} has <b>bold</b>, <i>italic</i> and " \
+    "<a href='/posts/{}'>a link</a>.</p><p>A second paragraph.</p>"
+
+
+class MeldImplementation(object):
+    # The meld3 API, as provided by lxmlmeld or meld3 itself
+    def __init__(self, module):
+        self.module = importlib.import_module(module)
+
+    def parse(self, src):
+        return self.module.parse_htmlstring(src)
+
+    def find(self, ele, name):
+        return ele.findmeld(name)
+
+    def fill(self, ele, **values):
+        ele.fillmelds(**values)
+
+    def repeat(self, ele, iterable):
+        return ele.repeat(iterable)
+
+    def content(self, ele, text, structure=False):
+        ele.content(text, structure=structure)
+
+    def write(self, root):
+        return root.write_htmlstring()
+
+
+class LxmlImplementation(object):
+    # The same operations done directly with lxml, as a baseline
+    def __init__(self):
+        self._find = etree.XPath(
+            "descendant-or-self::*[@*[name()='meld:id']=$name]"
+        )
+        self._melds = etree.XPath("//*[@*[name()='meld:id']]")
+
+    def parse(self, src):
+        return etree.fromstring(src, etree.HTMLParser())
+
+    def find(self, ele, name):
+        found = self._find(ele, name=name)
+        return found[0] if found else None
+
+    def fill(self, ele, **values):
+        for name, value in values.items():
+            self.content(self.find(ele, name), value)
+
+    def repeat(self, ele, iterable):
+        tail, ele.tail = ele.tail, None
+        for data in iterable:
+            copy = ele.__deepcopy__({})
+            yield ele, data
+            ele.addnext(copy)
+            ele = copy
+        parent, prev = ele.getparent(), ele.getprevious()
+        if tail and prev is not None:
+            prev.tail = (prev.tail or "") + tail
+        elif tail:
+            parent.text = (parent.text or "") + tail
+        parent.remove(ele)
+
+    def content(self, ele, text, structure=False):
+        ele[:] = []
+        if structure:
+            wrapper = etree.fromstring("<dispose>{}</dispose>".format(text))
+            ele.text = wrapper.text
+            ele.extend(wrapper)
+        else:
+            ele.text = text
+
+    def write(self, root):
+        for ele in self._melds(root):
+            del ele.attrib["meld:id"]
+        return etree.tostring(root, method="html", doctype=DOCTYPE)
+
+
+def simple_fill(impl, size):
+    # A page with a few melds filled in
+    root = impl.parse(PAGE)
+    impl.fill(
+        root, title="A page", heading="Welcome <back>",
+        intro="Some introductory text & more", updated="Today",
+        content="The main content of the page", footer="The footer"
+    )
+    return impl.write(root)
+
+
+def table(impl, size):
+    # A table with a row per item
+    root = impl.parse(TABLE)
+    for row, i in impl.repeat(impl.find(root, "row"), range(size)):
+        impl.fill(
+            row, id=str(i), name="Name {}".format(i), value=str(i * 1.5)
+        )
+    return impl.write(root)
+
+
+def nested_repeats(impl, size):
+    # Groups of items, repeating within a repeat
+    root = impl.parse(NESTED)
+    per_group = 100
+    groups = [
+        range(start, min(start + per_group, size))
+        for start in range(0, size, per_group)
+    ]
+    for group, items in impl.repeat(impl.find(root, "group"), groups):
+        impl.fill(group, group_name="Group {}".format(items.start))
+        for item, i in impl.repeat(impl.find(group, "item"), items):
+            impl.fill(item, item_name="Item {}".format(i), item_count=str(i))
+    return impl.write(root)
+
+
+def structure_inserts(impl, size):
+    # Posts whose bodies are fragments of markup
+    root = impl.parse(POSTS)
+    for post, i in impl.repeat(impl.find(root, "post"), range(size)):
+        impl.fill(post, post_title="Post {}".format(i))
+        impl.content(
+            impl.find(post, "post_body"), POST_BODY.format(i, i),
+            structure=True
+        )
+    return impl.write(root)
+
+
+# Name: (function, size at scale 1)
+WORKLOADS = {
+    "simple_fill": (simple_fill, 1),
+    "table_10k": (table, 10000),
+    "nested_repeats": (nested_repeats, 10000),
+    "structure_inserts": (structure_inserts, 1000),
+}
+
+IMPLEMENTATIONS = {
+    "lxmlmeld": lambda: MeldImplementation("lxmlmeld"),
+    "lxml": LxmlImplementation,
+    "meld3": lambda: MeldImplementation("meld3"),
+}
+
+
+def available_implementations():
+    """
+    Returns the names of the implementations that can be run here.
+    """
+    ret = []
+    for name, factory in IMPLEMENTATIONS.items():
+        try:
+            factory()
+        except ImportError:
+            continue
+        ret.append(name)
+    return ret
+
+
+def _max_rss():
+    # Peak resident set size of this process in bytes, where known
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_case(workload, implementation, iterations=5, scale=1.0):
+    """
+    Runs one workload with one implementation in this process and returns
+    a dict of results.
+    """
+    func, size = WORKLOADS[workload]
+    size = max(1, int(size * scale))
+    impl = IMPLEMENTATIONS[implementation]()
+    rss_before = _max_rss()
+
+    output = func(impl, size)  # warm up
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func(impl, size)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(impl, size)
+    python_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    median = statistics.median(times)
+    rss_after = _max_rss()
+    return {
+        "workload": workload,
+        "implementation": implementation,
+        "size": size,
+        "iterations": iterations,
+        "seconds_min": min(times),
+        "seconds_median": median,
+        "seconds_mean": statistics.mean(times),
+        "renders_per_second": 1 / median if median else None,
+        "output_bytes": len(output),
+        "output_mb_per_second":
+            len(output) / median / 1e6 if median else None,
+        "python_peak_bytes": python_peak,
+        "max_rss_bytes": rss_after,
+        "rss_growth_bytes":
+            rss_after - rss_before if rss_after is not None else None,
+    }
+
+
+def _environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(
+            datetime.timezone.utc
+        ).isoformat(),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "lxml": ".".join(map(str, etree.LXML_VERSION)),
+        "libxml2": ".".join(map(str, etree.LIBXML_VERSION)),
+    }
+
+
+def run(workloads=None, implementations=None, iterations=5, scale=1.0,
+        isolate=True):
+    """
+    Runs each of the workloads with each of the implementations (all of
+    those available if not given) and returns a dict with the environment
+    and a list of results. With isolate, each case has its own process.
+    """
+    workloads = workloads or list(WORKLOADS)
+    implementations = implementations or available_implementations()
+    results = []
+    for workload in workloads:
+        for implementation in implementations:
+            if not isolate:
+                results.append(
+                    run_case(workload, implementation, iterations, scale)
+                )
+                continue
+            proc = subprocess.run(
+                [
+                    sys.executable, os.path.abspath(__file__),
+                    "--case", "{}:{}".format(workload, implementation),
+                    "--iterations", str(iterations), "--scale", str(scale),
+                ],
+                capture_output=True, text=True, check=True
+            )
+            results.append(json.loads(proc.stdout))
+    return {"environment": _environment(), "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--workload", action="append", choices=sorted(WORKLOADS),
+        help="workload to run (repeatable; default all)"
+    )
+    parser.add_argument(
+        "--implementation", action="append", choices=sorted(IMPLEMENTATIONS),
+        help="implementation to run (repeatable; default all available)"
+    )
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument(
+        "--scale", type=float, default=1.0,
+        help="multiplies the size of each workload"
+    )
+    parser.add_argument("--output", help="file to write (default stdout)")
+    parser.add_argument(
+        "--no-isolate", action="store_true",
+        help="run every case in this process"
+    )
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        workload, implementation = args.case.split(":")
+        report = run_case(workload, implementation, args.iterations,
+                          args.scale)
+    else:
+        report = run(
+            args.workload, args.implementation, args.iterations, args.scale,
+            not args.no_isolate
+        )
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,14 @@
-from copy import deepcopy
+import functools
+import os
+import re
+import threading
+import types
+import zlib
+
 from lxml import etree
 
 NS = "http://www.plope.com/software/meld3"
+_MELD_ID = "{%s}id" % NS
 
 
 class _DoctypeDict(object):
@@ -41,11 +48,286 @@ doctypes = _DoctypeDict(
     xhtml='<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
           '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">',
     xhtml_strict='<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
-                 '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">'
+                 '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">',
+    html5='<!DOCTYPE html>'
 )
 
 
+_FIND_MELD = "descendant-or-self::*[@meld:id=$name]"
+_FIND_MELDS = "descendant-or-self::*[@meld:id]"
+_FIND_MELD_IDS = "//@meld:id"
+_FIND_HTML_MELD_IDS = "//@*[name()='meld:id']"
+_FIND_OWN_ELEMENTS = "//meld:*"
+_FIND_OWN_ATTRIBUTES = "//*[@*[namespace-uri()='{}']]".format(NS)
+
+# Compressors for the compress argument of the write_* calls, by name. Each
+# is a callable returning an object with compress() and flush() methods,
+# like zlib.compressobj(); others (eg. brotli) can be added.
+compressors = {
+    "gzip": functools.partial(zlib.compressobj, 6, zlib.DEFLATED, 31),
+    "deflate": functools.partial(zlib.compressobj, 6, zlib.DEFLATED, 15),
+}
+
+# XPath expressions are compiled, and parsers created, on first use. They
+# are kept per-thread as lxml only lets one thread use each at a time.
+_local = threading.local()
+
+
+def _account(operation, nodes, output=None):
+    # Hook for lxmlmeld.accounting; does nothing unless an account is active.
+    # output is a number of bytes, or the output itself (where text is
+    # counted as UTF-8).
+    account = getattr(_local, "account", None)
+    if account is not None:
+        if isinstance(output, str):
+            output = len(output.encode("utf-8"))
+        elif isinstance(output, bytes):
+            output = len(output)
+        account.add(operation, nodes, output)
+
+
+def _xpath(expr):
+    try:
+        cache = _local.xpaths
+    except AttributeError:
+        cache = _local.xpaths = {}
+    try:
+        return cache[expr]
+    except KeyError:
+        ret = cache[expr] = etree.XPath(expr, namespaces={"meld": NS})
+        return ret
+
+
+def _column_values(values):
+    if hasattr(values, "tolist"):
+        return values.tolist()
+    return values if isinstance(values, (list, tuple)) else list(values)
+
+
+def _relative_path(ancestor, node):
+    # The list of child indexes to follow to get from ancestor to node
+    path = []
+    while node is not ancestor:
+        parent = node.getparent()
+        path.append(parent.index(node))
+        node = parent
+    path.reverse()
+    return path
+
+
+def _meld_paths(ele):
+    # Maps each meld:id within ele to its path, keeping the first (as
+    # findmeld() would) where the meld:id has been duplicated by repeat()
+    paths = {}
+    for meld in ele.findmelds():
+        paths.setdefault(meld.get(_MELD_ID), _relative_path(ele, meld))
+    return paths
+
+
+def _walk(ele, path):
+    for idx in path:
+        ele = ele[idx]
+    return ele
+
+
+def _put_in_place(placeholder, eles):
+    # Replaces placeholder with eles, keeping its tail after them
+    parent, tail = placeholder.getparent(), placeholder.tail
+    idx = parent.index(placeholder)
+    parent[idx:idx + 1] = eles
+    if not tail:
+        return
+    if eles:
+        eles[-1].tail = tail
+    elif idx > 0:
+        parent[idx - 1].tail = (parent[idx - 1].tail or "") + tail
+    else:
+        parent.text = (parent.text or "") + tail
+
+
+class _Prototype(object):
+    # An element prepared for repeat_nested(): a copy of it with each nested
+    # prototype (compiled in turn) swapped for a placeholder, and the paths
+    # to its melds and placeholders
+    def __init__(self, ele, nested):
+        if not hasattr(nested, "items"):
+            nested = dict.fromkeys(nested, ())
+        self.shell = ele.__deepcopy__({})
+        self.shell.tail = None
+        placeholders = {}
+        for name, inner in nested.items():
+            child = self.shell.findmeld(name)
+            if child is None or child is self.shell:
+                raise ValueError("No meld:id {} in row".format(name))
+            placeholder = etree.Comment()
+            placeholder.tail = child.tail
+            child.getparent().replace_child(child, placeholder)
+            placeholders[name] = (placeholder, _Prototype(child, inner))
+        self.paths = _meld_paths(self.shell)
+        self.nested = [
+            (name, _relative_path(self.shell, placeholder), prototype)
+            for name, (placeholder, prototype) in placeholders.items()
+        ]
+
+    def stamp(self, rows, formatter):
+        # Returns a filled-in copy for each row
+        ret = []
+        for row in rows:
+            copy = self.shell.__deepcopy__({})
+            _account("repeat", copy)
+            # Everything is found before anything is changed, so that the
+            # paths stay valid
+            cells = []
+            for name, value in row.items():
+                path = self.paths.get(name)
+                if path is not None:
+                    cells.append((_walk(copy, path), value))
+                elif all(name != nested[0] for nested in self.nested):
+                    raise ValueError("No meld:id {} in row".format(name))
+            holes = [
+                (_walk(copy, path), prototype, row.get(name, ()))
+                for name, path, prototype in self.nested
+            ]
+            for hole, prototype, rows in holes:
+                _put_in_place(hole, prototype.stamp(rows, formatter))
+            for cell, value in cells:
+                cell.content(value, formatter=formatter)
+            ret.append(copy)
+        return ret
+
+
+class _Writer(object):
+    # Gives bytearrays, lists and other writable buffers a write() method,
+    # and counts what is written
+    def __init__(self, target):
+        self.written = 0
+        if hasattr(target, "write"):
+            self._write = target.write
+        elif isinstance(target, bytearray):
+            self._write = target.extend
+        elif isinstance(target, list):
+            self._write = target.append
+        else:
+            self._view = memoryview(target).cast("B")
+            self._write = self._copy
+
+    def _copy(self, data):
+        end = self.written + len(data)
+        if end > len(self._view):
+            raise ValueError("Output does not fit in the buffer")
+        self._view[self.written:end] = data
+
+    def write(self, data):
+        self._write(data)
+        self.written += len(data)
+
+
+class _Substituting(object):
+    # A file-like object that replaces markers (matching pattern, whose
+    # group is an index into replacements) in what is written to it before
+    # passing it on to sink. A marker split across writes is held back
+    # until it is complete; finish() writes anything left.
+    def __init__(self, sink, pattern, replacements):
+        self._sink = sink
+        self._pattern = re.compile(pattern)
+        self._replacements = replacements
+        self._pending = b""
+
+    def _replace(self, data):
+        return self._pattern.sub(
+            lambda m: self._replacements[int(m.group(1))], data
+        )
+
+    def write(self, data):
+        data = self._pending + data
+        # A marker can't contain "<" or ">", so one that isn't complete
+        # starts at the last "<" with no ">" after it
+        cut = data.rfind(b"<")
+        if cut == -1 or b">" in data[cut:]:
+            cut = len(data)
+        self._pending = data[cut:]
+        if cut:
+            self._sink.write(self._replace(data[:cut]))
+
+    def finish(self):
+        if self._pending:
+            self._sink.write(self._replace(self._pending))
+            self._pending = b""
+
+
+def _stream(file, write):
+    # Calls write() with a file-like object for file (anything the write_*
+    # calls accept, or None for bytes), accounts for what was written and
+    # returns what the write_* call should.
+    chunks = opened = None
+    if file is None:
+        file = chunks = []
+    elif isinstance(file, (str, os.PathLike)):
+        file = opened = open(file, "wb")
+    sink = _Writer(file)
+    try:
+        write(sink)
+    finally:
+        if opened is not None:
+            opened.close()
+    _account("write", (), sink.written)
+    if chunks is not None:
+        return b"".join(chunks)
+    return None if hasattr(file, "write") else sink.written
+
+
+class _Compressing(object):
+    # Used as a context manager, a file-like object that compresses what is
+    # written to it and passes it on to target (anything the write_* calls
+    # accept). Afterwards result is what the write_* call should return.
+    def __init__(self, target, compress):
+        factory = compress if callable(compress) else compressors.get(compress)
+        if factory is None:
+            raise ValueError("Unknown compression: {}".format(compress))
+        self._compressor = factory()
+        self._target = target
+        self.result = None
+
+    def __enter__(self):
+        target = self._target
+        if target is None:
+            target = self._chunks = []
+        if isinstance(target, (str, os.PathLike)):
+            self._file = open(target, "wb")
+            self._sink = _Writer(self._file)
+        else:
+            self._file = None
+            self._sink = _Writer(target)
+        return self
+
+    def write(self, data):
+        if isinstance(data, str):
+            raise ValueError("Only bytes output can be compressed")
+        data = self._compressor.compress(data)
+        if data:
+            self._sink.write(data)
+
+    def __exit__(self, exc_type, *exc_info):
+        try:
+            if exc_type is None:
+                self._sink.write(self._compressor.flush())
+                _account("compress", (), self._sink.written)
+        finally:
+            if self._file is not None:
+                self._file.close()
+        if self._target is None:
+            self.result = b"".join(self._chunks)
+        elif self._file is None and not hasattr(self._target, "write"):
+            self.result = self._sink.written
+        return False
+
+
 class Element(etree.ElementBase):
+    # Used by content() to turn non-text values (ints, floats, Decimals...)
+    # into text. Can be replaced (on this class or a subclass) with any
+    # callable taking one argument.
+    formatter = staticmethod(str)
+
     def __repr__(self):
         return "<{} {} at {}>".format(
             self.__class__.__name__, self.tag, id(self)
@@ -58,21 +340,64 @@ class Element(etree.ElementBase):
         is passed in as parent the newly-copied element will be appended
         to this parent element. Returns the new element.
         """
-        ret = deepcopy(self)
+        ret = self._copy()
+        _account("clone", ret)
         if parent is not None:
             parent.append(ret)
         return ret
 
+    def _copy(self):
+        return self.__deepcopy__({})
+
+    def freeze(self):
+        """
+        Returns a read-only copy of this element and all of its children,
+        for sharing between threads. The copy is made of FrozenElements,
+        whose methods and properties raise FrozenError from any change to
+        the tree (including lxml's own, such as append() or setting text).
+        lxml's module-level functions, such as etree.SubElement() and
+        etree.strip_attributes(), can't be stopped and mustn't be used on
+        it. findmeld(), findmelds() and the write_* calls can be used on it
+        from any number of threads at once without locking, and clone()
+        gives an ordinary (changeable) copy, eg. to fill in for one request.
+        An ordinary tree is only safe to use from several threads while none
+        of them change it.
+        """
+        holder = etree.fromstring("<dispose/>", _parser(element=FrozenElement))
+        etree.ElementBase.append(holder, self.__deepcopy__({}))
+        ret = holder[0].__deepcopy__({})
+        # Everything that findmeld() and clone() need is worked out now, so
+        # nothing is ever set on the frozen tree afterwards.
+        index = {}
+        for ele in ret.findmelds():
+            index.setdefault(ele.get(_MELD_ID), ele)
+        ret._meld_index = index
+        return ret
+
     def findmeld(self, name, default=None):
         """
         Searches this element and all children for any with a meld:id
         attribute with value equal to the name parameter. Returns
         default (None if not supplied) if the node account be found.
+
+        The first match in document order is returned, except on an element
+        given by repeat(): there, if the element at the meld's original
+        position still has that meld:id, it is returned without searching,
+        even if another element with the same meld:id has since been put
+        before it.
         """
-        ret = self.xpath(
-            "descendant-or-self::*[@meld:id='{}']".format(name),
-            namespaces={"meld": NS}
-        )
+        paths = getattr(self, "_meld_paths", None)
+        if paths is not None and name in paths:
+            # A row from repeat(); try the position the meld had in the
+            # original element before falling back to searching.
+            try:
+                ele = _walk(self, paths[name])
+            except IndexError:
+                pass
+            else:
+                if ele.get(_MELD_ID) == name:
+                    return ele
+        ret = _xpath(_FIND_MELD)(self, name=name)
         return ret[0] if ret else default
 
     def findmelds(self):
@@ -80,16 +405,14 @@ class Element(etree.ElementBase):
         Returns an iterable of all elements (this one or children) with a
         meld:id attribute (of any value).
         """
-        return self.xpath(
-            "descendant-or-self::*[@meld:id]", namespaces={"meld": NS}
-        )
+        return _xpath(_FIND_MELDS)(self)
 
     def meldid(self):
         """
         Returns the value of the meld:id attribute of this element, or None
         if this element does not have a meld:id attribute.
         """
-        return self.get(etree.QName(NS, "id").text)
+        return self.get(_MELD_ID)
 
     def repeat(self, iterable, childname=None):
         """
@@ -100,14 +423,22 @@ class Element(etree.ElementBase):
 
         The target element is by default this element, but if a meld:id is pass
         in as childname then this element will be found and used instead.
+
+        The positions of the melds within the target element are noted once,
+        so calling findmeld() on each new_element doesn't need to search it.
+        A meld still at its original position is found there even if an
+        element with the same meld:id is added before it (see findmeld()).
         """
         thing = self.findmeld(childname) if childname else self
+        paths = _meld_paths(thing)
         tail = thing.tail
         thing.tail = None
         prev_thing = None
         for data in iterable:
-            next_thing = thing.clone()
+            next_thing = thing.__deepcopy__({})
+            _account("repeat", next_thing)
             prev_thing = thing
+            thing._meld_paths = paths
             yield thing, data
             thing.addnext(next_thing)
             thing = next_thing
@@ -125,6 +456,56 @@ class Element(etree.ElementBase):
                     parent.text = tail
         thing.getparent().remove(thing)
 
+    def repeat_table(self, columns, childname=None, formatter=None):
+        """
+        Repeats the target element (as for repeat()) once per row of
+        column-oriented data, filling in the cells of each row as it goes.
+        columns is a mapping of meld:id to a sequence of values for that
+        cell; all sequences must be the same length. Anything with a tolist()
+        method (eg. NumPy arrays, array.array or memoryview) is converted
+        first. Values are set using content(). Returns nothing.
+
+        The position of each cell within the target element is worked out
+        once, so rows are filled without searching for each cell.
+        """
+        thing = self.findmeld(childname) if childname else self
+        names = list(columns)
+        cols = [_column_values(columns[name]) for name in names]
+        if len(set(len(col) for col in cols)) > 1:
+            raise ValueError("Columns must all be the same length")
+        all_paths = _meld_paths(thing)
+        paths = []
+        for name in names:
+            if name not in all_paths:
+                raise ValueError("No meld:id {} in row".format(name))
+            paths.append(all_paths[name])
+        for row, data in self.repeat(zip(*cols), childname):
+            for path, value in zip(paths, data):
+                _walk(row, path).content(value, formatter=formatter)
+
+    def repeat_nested(self, rows, childname=None, nested=(), formatter=None):
+        """
+        Repeats the target element (as for repeat()) once per item of rows,
+        filling in each copy from the item, which is a mapping of meld:id to
+        value. Values are set using content(), except for the meld:ids
+        given in nested: these are repeated within the copy, in the same
+        way, once per item of their value (eg. the rows of each group of a
+        grouped table). For more levels, nested can be a mapping of each of
+        these meld:ids to the meld:ids nested within it, and so on. Raises
+        ValueError for meld:ids that aren't in the element. Returns nothing.
+
+        Each level is prepared once, and copies are made from unfilled
+        elements, so the work done is in proportion to the output.
+        """
+        thing = self.findmeld(childname) if childname else self
+        if thing.getparent() is None:
+            raise ValueError("Can't repeat the root element")
+        copies = _Prototype(thing, nested).stamp(rows, formatter)
+        placeholder = etree.Comment()
+        placeholder.tail = thing.tail
+        thing.getparent().replace_child(thing, placeholder)
+        _put_in_place(placeholder, copies)
+
     def replace_child(self, old_element, new_element):
         """
         Looks for this old_element as a direct child of this element, removes
@@ -186,15 +567,22 @@ class Element(etree.ElementBase):
 
         return idx
 
-    def content(self, text, structure=False):
+    def content(self, text, structure=False, formatter=None):
         """
         Sets the content of this element. It removes all of the text and child
         elements before doing so. You can pass in text, an lxml element or list
         of lxml elements to use as the new contents. If you pass in text and
         set structure to true then the text will be treated as a fragment of
-        XML, parsed and inserted. Returns nothing.
+        XML, parsed and inserted. Any other value (eg. a number) is converted
+        to text using formatter, or Element.formatter if not given. Returns
+        nothing.
         """
-        if isinstance(text, (list, tuple)):
+        if not structure and (type(text) is str or text is None):
+            # Fast path for the common case of plain text
+            if len(self):
+                self[:] = []
+            self.text = text
+        elif isinstance(text, (list, tuple)):
             self.text = None
             self[:] = list(text)
         elif isinstance(text, etree._Element):
@@ -202,9 +590,13 @@ class Element(etree.ElementBase):
             self[:] = [text]
         elif structure:
             xml = etree.XML("<dispose>{}</dispose>".format(text))
+            _account("content", list(xml))
             self.content(list(xml) or xml.text)
         else:
-            self[:] = []
+            if len(self):
+                self[:] = []
+            if not isinstance(text, (str, bytes)):
+                text = (formatter or type(self).formatter)(text)
             self.text = text
 
     def attributes(self, **kwargs):
@@ -235,6 +627,26 @@ class Element(etree.ElementBase):
                 missing.add(k)
         return list(missing)
 
+    def fill_column(self, name, values, formatter=None):
+        """
+        Finds every element with a meld:id equal to name (eg. the same cell
+        in each of a set of rows produced by repeat()) and sets the content of
+        each, in document order, to the corresponding item of values (which
+        is treated as for the columns of repeat_table()).
+        Raises ValueError if the number of values doesn't match the number of
+        elements found. Returns nothing.
+        """
+        eles = _xpath(_FIND_MELD)(self, name=name)
+        values = _column_values(values)
+        if len(eles) != len(values):
+            raise ValueError(
+                "{} elements with meld:id {} but {} values".format(
+                    len(eles), name, len(values)
+                )
+            )
+        for ele, value in zip(eles, values):
+            ele.content(value, formatter=formatter)
+
     def __mod__(self, **kwargs):
         """
         Alias for fillmelds.
@@ -269,20 +681,12 @@ class Element(etree.ElementBase):
 
     def _clone_without_own_ns(self):
         new = self.clone()
-        for node in new.xpath("//meld:*", namespaces={"meld": NS}):
-            node.getparent().remove(node)
-        for node in new.xpath("//*[@*[namespace-uri()='{}']]".format(NS)):
-            to_remove = [
-                k for k in node.attrib.keys() if etree.QName(k).namespace == NS
-            ]
-            for k in to_remove:
-                del node.attrib[k]
-        etree.cleanup_namespaces(new)
+        _strip_own_ns(new)
         return new
 
     def write_xml(self, file, encoding=None, doctype=None, fragment=False,
-                  declaration=True, pipeline=False, _kwargs={"method": "xml"},
-                  _doc=None):
+                  declaration=True, pipeline=False, parallel=None, split=None,
+                  compress=None, _kwargs={"method": "xml"}, _doc=None):
         """
         Writes this document as XML to a file (filename or file-like object).
         The document will use the encoding and doctype specified. Doctype
@@ -292,7 +696,35 @@ class Element(etree.ElementBase):
         or XML declaration is emitted regardless of their values. By default
         all meld:ids are stripped from the serialised output, but if pipeline
         is set to true then they are serialised.
+
+        The output is streamed to the file in chunks rather than built up in
+        memory first. Instead of a file you can also pass a bytearray (which
+        the output is appended to), a list (which chunks of output are
+        appended to, eg. for socket.sendmsg()) or any other writable buffer
+        such as a memoryview (which the output is copied into, raising
+        ValueError if it doesn't fit); for these the number of bytes written
+        is returned.
+
+        For very large documents, parallel can be set to a number of threads,
+        True (for one per CPU) or a concurrent.futures thread pool to
+        serialise the children of the root element in chunks concurrently.
+        If split is given it is the meld:id of the element whose children
+        (eg. the rows of a repeat()) are split up instead; ValueError is
+        raised if there's no such meld. The output is the same either way.
+
+        If compress is given the output is compressed as it is written.
+        compress is "gzip", "deflate" (zlib, as for HTTP) or another name
+        added to lxmlmeld.compressors, or a callable returning an object with
+        compress() and flush() methods such as zlib.compressobj().
         """
+        if compress:
+            with _Compressing(file, compress) as out:
+                self.write_xml(
+                    out, encoding, doctype, fragment, declaration, pipeline,
+                    parallel, split, None, _kwargs, _doc
+                )
+            return out.result
+
         kwargs = {k: v for k, v in _kwargs.items()}
         kwargs.update(xml_declaration=declaration, encoding=encoding)
         if doctype:
@@ -302,27 +734,56 @@ class Element(etree.ElementBase):
         if fragment:
             kwargs.update(doctype=None, xml_declaration=False)
 
+        container = None
         if _doc is not None:
-            doc = _doc
+            doc = container = _doc
         elif pipeline:
             doc = self
+            parallel = None
+        elif parallel:
+            # split has to be found before the meld:ids are stripped
+            doc = self.clone()
+            container = doc.findmeld(split) if split else doc
+            if container is None:
+                raise ValueError("No meld:id {}".format(split))
+            _strip_own_ns(doc)
         else:
             doc = self._clone_without_own_ns()
 
-        ret = etree.tostring(doc, **kwargs)
-        if file:
-            # ElementTree.write() doesn't support doctype
-            try:
-                file.write(ret)
-            except AttributeError:
-                with open(file, "wb") as fh:
-                    fh.write(ret)
-            return None
-        else:
+        if parallel and _ascii_compatible(kwargs["encoding"]):
+            if container is not None and len(container) > 1:
+                chunks = _serialise_parallel(doc, container, parallel, kwargs)
+                _account("write", (), sum(len(c) for c in chunks))
+                if file is None:
+                    return b"".join(chunks)
+                return _write_chunks(file, chunks)
+
+        if file is None:
+            ret = etree.tostring(doc, **kwargs)
+            _account("write", (), ret)
             return ret
+        if isinstance(kwargs["encoding"], type) or \
+                str(kwargs["encoding"]).lower() == "unicode":
+            # xmlfile only writes bytes, so text goes out in one piece
+            ret = etree.tostring(doc, **kwargs)
+            _account("write", (), ret)
+            file.write(ret)
+            return None
+
+        def write(sink):
+            # Unlike ElementTree.write() this writes only this element (and
+            # not the doctype, comments, etc. around the root element).
+            with etree.xmlfile(sink, encoding=kwargs["encoding"]) as xf:
+                if kwargs["xml_declaration"] and kwargs["method"] == "xml":
+                    xf.write_declaration()
+                if kwargs.get("doctype"):
+                    xf.write_doctype(kwargs["doctype"])
+                xf.write(doc, method=kwargs["method"])
+        return _stream(file, write)
 
     def write_xhtml(self, file, encoding=None, doctype=doctypes.xhtml,
-                    fragment=False, declaration=False, pipeline=False):
+                    fragment=False, declaration=False, pipeline=False,
+                    parallel=None, compress=None):
         """
         Writes this document as XHTML to a file (filename or file-like object).
         The document will use the encoding and doctype specified. Doctype
@@ -331,38 +792,176 @@ class Element(etree.ElementBase):
         to true.  If fragment is true then no doctype or XML declaration is
         emitted regardless of their values. By default all meld:ids are
         stripped from the serialised output, but if pipeline is set to true
-        then they are serialised.
+        then they are serialised. See write_xml for parallel, which here
+        always splits the children of the root element, and compress.
         """
 
         # libxml2/lxml is seriously finicky about XHTML and does it based on
         # sniffing the doctype, apparently at parse time. Furthermore
         # _cleanup_namespacesStart is enough to break the magic. Start by
         # serialising as XML with an XHTML doctype and then re-parsing to get
-        # the magic before emitting with the correct options.
-        intermediate = self.write_xml(
-            None, encoding=encoding, doctype=doctypes.xhtml,
-            fragment=False, declaration=True, pipeline=pipeline
-        )
-        intermediate = etree.fromstring(intermediate)
+        # the magic before emitting with the correct options. This isn't
+        # output, so it isn't accounted for as a write.
+        intermediate = etree.fromstring(etree.tostring(
+            self if pipeline else self._clone_without_own_ns(),
+            method="xml", encoding=encoding, doctype=doctypes.xhtml,
+            xml_declaration=True
+        ))
         return self.write_xml(
             file, encoding=encoding, doctype=doctype, pipeline=True,
-            declaration=declaration, fragment=fragment, _doc=intermediate
+            declaration=declaration, fragment=fragment, parallel=parallel,
+            compress=compress, _doc=intermediate
         )
 
     def write_html(self, file, encoding=None, doctype=doctypes.html,
-                   fragment=False):
+                   fragment=False, parallel=None, split=None, compress=None):
         """
         Writes this document as HTML to a file (filename or file-like object).
         The document will use the encoding and doctype specified. Doctype
         can be a string or tuple. It defaults to HTML 4.01 Transitional.
         If fragment is true then no doctype is emitted regardless of the
-        doctype parameter value.
+        doctype parameter value. See write_xml for parallel, split and
+        compress.
         """
         return self.write_xml(
             file, encoding=encoding, doctype=doctype, fragment=fragment,
+            parallel=parallel, split=split, compress=compress,
             _kwargs={"method": "html"}
         )
 
+    def write_html5(self, file, encoding=None, doctype=doctypes.html5,
+                    fragment=False, minify=False, compress=None):
+        """
+        Writes this document as HTML5 to a file (filename or file-like
+        object), as for write_html. Void elements (eg. <source> and <wbr>)
+        are written without end tags, and anything inside one (eg. where
+        the HTML parser didn't know that an element was void) after it.
+        Elements in the XHTML namespace are written without it. Doctype
+        defaults to <!DOCTYPE html>.
+
+        If minify is true then whitespace between elements is collapsed to a
+        single space, or dropped next to known block-level elements (eg.
+        <div> and <p>, but not custom elements), and attribute values are
+        only quoted where HTML5 requires it. Whitespace inside
+        <pre>, <textarea>, <script> and <style> is kept. See write_xml for
+        compress.
+        """
+        if compress:
+            with _Compressing(file, compress) as out:
+                self.write_html5(out, encoding, doctype, fragment, minify)
+            return out.result
+
+        if isinstance(doctype, (tuple, list)):
+            doctype = '<!DOCTYPE {} PUBLIC "{}" "{}">'.format(*doctype)
+        if fragment:
+            doctype = None
+        text = isinstance(encoding, type) or str(encoding).lower() == "unicode"
+        if minify:
+            out = [doctype] if doctype else []
+            _write_html5(self, out)
+            ret = "".join(out)
+            if not text:
+                ret = ret.encode(encoding or "ascii", "xmlcharrefreplace")
+            _account("write", (), ret)
+            return ret if file is None else _write_chunks(file, [ret])
+
+        doc = self._clone_without_own_ns()
+        # Elements in the XHTML namespace (eg. from an XHTML template) are
+        # written without it, as an HTML parser would have read them, so
+        # that libxml2 knows which of them are void.
+        xhtml = list(doc.iter(_XHTML_PREFIX + "*"))
+        for ele in xhtml:
+            ele.tag = ele.tag[len(_XHTML_PREFIX):]
+        if xhtml:
+            etree.cleanup_namespaces(doc)
+        # libxml2 already writes most void elements as HTML5 wants, so only
+        # the others are replaced by a marker and written here.
+        token = os.urandom(8).hex()
+        tags = []
+        for ele in list(doc.iter(*_HTML5_UNKNOWN_VOID)):
+            parent = ele.getparent()
+            if parent is None:
+                continue
+            # Anything inside the element is moved to after it
+            children = list(ele)
+            marker = etree.Comment("{}:{}".format(token, len(tags)))
+            marker.tail, ele.text = ele.text, None
+            last = children[-1] if children else marker
+            last.tail = (last.tail or "") + (ele.tail or "") or None
+            idx = parent.index(ele)
+            parent[idx:idx + 1] = [marker] + children
+            shell = _shell(parent.tag, parent.nsmap)
+            ele.tail = None
+            shell.append(ele)
+            tag = _serialise_shell(
+                shell, {"method": "html", "encoding": "unicode"}
+            )
+            tags.append(tag[:tag.rindex("</")])
+        pattern = "<!--{}:([0-9]+)-->".format(token)
+
+        if text:
+            ret = re.sub(
+                pattern, lambda m: tags[int(m.group(1))], etree.tostring(
+                    doc, method="html", encoding="unicode", doctype=doctype
+                )
+            )
+            _account("write", (), ret)
+            return ret if file is None else _write_chunks(file, [ret])
+
+        tags = [
+            tag.encode(encoding or "ascii", "xmlcharrefreplace")
+            for tag in tags
+        ]
+
+        def write(sink):
+            out = _Substituting(sink, pattern.encode("ascii"), tags)
+            with etree.xmlfile(out, encoding=encoding) as xf:
+                if doctype:
+                    xf.write_doctype(doctype)
+                xf.write(doc, method="html")
+            out.finish()
+        return _stream(file, write)
+
+    def write_xmlchunks(self, *args, **kwargs):
+        """
+        Returns the document as a list of bytes strings which together make
+        up the XML. See write_xml for the options you can specify to this
+        call.
+        """
+        ret = []
+        self.write_xml(ret, *args, **kwargs)
+        return ret
+
+    def write_xhtmlchunks(self, *args, **kwargs):
+        """
+        Returns the document as a list of bytes strings which together make
+        up the XHTML. See write_xhtml for the options you can specify to this
+        call.
+        """
+        ret = []
+        self.write_xhtml(ret, *args, **kwargs)
+        return ret
+
+    def write_htmlchunks(self, *args, **kwargs):
+        """
+        Returns the document as a list of bytes strings which together make
+        up the HTML. See write_html for the options you can specify to this
+        call.
+        """
+        ret = []
+        self.write_html(ret, *args, **kwargs)
+        return ret
+
+    def write_html5chunks(self, *args, **kwargs):
+        """
+        Returns the document as a list of bytes strings which together make
+        up the HTML5. See write_html5 for the options you can specify to this
+        call.
+        """
+        ret = []
+        self.write_html5(ret, *args, **kwargs)
+        return ret
+
     def write_xmlstring(self, *args, **kwargs):
         """
         Returns the document as a bytes string, formatted as XML. See
@@ -384,21 +983,303 @@ class Element(etree.ElementBase):
         """
         return self.write_html(None, *args, **kwargs)
 
+    def write_html5string(self, *args, **kwargs):
+        """
+        Returns the document as a bytes string, formatted as HTML5. See
+        write_html5 for the options you can specify to this call.
+        """
+        return self.write_html5(None, *args, **kwargs)
+
+
+class FrozenError(TypeError):
+    """
+    Raised on an attempt to change a tree made read-only by freeze().
+    """
+
+
+def _frozen(*args, **kwargs):
+    raise FrozenError("Can't change a frozen element")
+
+
+def _frozen_property(name):
+    prop = getattr(etree.ElementBase, name)
+    return property(prop.__get__, _frozen, _frozen)
+
+
+class FrozenElement(Element):
+    """
+    An element of a tree returned by Element.freeze(). It can be searched and
+    serialised like any other Element but any attempt to change it through
+    its methods or properties raises FrozenError.
+    """
+
+    base = _frozen_property("base")
+    text = _frozen_property("text")
+    tail = _frozen_property("tail")
+    tag = _frozen_property("tag")
+
+    @property
+    def attrib(self):
+        return types.MappingProxyType(dict(self.items()))
+
+    set = append = extend = insert = remove = clear = _frozen
+    addnext = addprevious = __setitem__ = __delitem__ = _frozen
+    repeat = repeat_table = repeat_nested = replace = replace_child = \
+        content = _frozen
+    attributes = fillmelds = fill_column = deparent = _frozen
+
+    def findmeld(self, name, default=None):
+        """
+        As for Element.findmeld(). On the root of the frozen tree this uses
+        the index made by freeze(), which can't go out of date.
+        """
+        index = getattr(self, "_meld_index", None)
+        if index is not None:
+            return index.get(name, default)
+        return Element.findmeld(self, name, default)
+
+    def _copy(self):
+        # Copies this part of the tree into a document that makes ordinary
+        # Elements, and copies it again from there so that it is the root
+        holder = etree.fromstring("<dispose/>", _parser())
+        holder.append(self.__deepcopy__({}))
+        return holder[0].__deepcopy__({})
+
+
+def _strip_own_ns(tree):
+    # Removes meld elements and attributes from tree, in place
+    for node in _xpath(_FIND_OWN_ELEMENTS)(tree):
+        node.getparent().remove(node)
+    for node in _xpath(_FIND_OWN_ATTRIBUTES)(tree):
+        to_remove = [
+            k for k in node.attrib.keys() if etree.QName(k).namespace == NS
+        ]
+        for k in to_remove:
+            del node.attrib[k]
+    etree.cleanup_namespaces(tree)
+
+
+def _ascii_compatible(encoding):
+    if encoding is None:
+        return True
+    try:
+        return "<>".encode(encoding) == b"<>"
+    except (LookupError, TypeError):
+        return False
+
+
+def _shell(tag, nsmap, doctype=b""):
+    # A new empty element, as the root of its own document, in which
+    # children of an element with the given tag and namespaces can be
+    # serialised in the same context (as libxml2 picks how to serialise
+    # from it, this includes the doctype).
+    empty = etree.tostring(etree.Element(tag, nsmap=nsmap))
+    return etree.fromstring(doctype + empty)
+
+
+def _serialise_shell(shell, kwargs):
+    # Serialises the content of shell, without shell's own tags
+    if shell.text is None and not len(shell):
+        return b""
+    ret = etree.tostring(
+        shell, method=kwargs["method"], encoding=kwargs["encoding"],
+        xml_declaration=False
+    )
+    start, end = (">", "</") if isinstance(ret, str) else (b">", b"</")
+    return ret[ret.index(start) + 1:ret.rindex(end)]
+
+
+def _serialise_parallel(doc, container, parallel, kwargs):
+    # Moves the children of container, in runs, into separate documents
+    # that can be serialised concurrently, leaving a marker in their place
+    # so that the rest of doc can be serialised around them.
+    children = list(container)
+    if parallel is True:
+        parallel = os.cpu_count() or 1
+    if isinstance(parallel, int):
+        from concurrent.futures import ThreadPoolExecutor
+        workers, executor = parallel, ThreadPoolExecutor(parallel)
+    else:
+        workers, executor = os.cpu_count() or 1, None
+    size = -(-len(children) // (workers * 2))
+    doctype = doc.getroottree().docinfo.doctype.encode("utf-8")
+    shells = []
+    for start in range(0, len(children), size):
+        shell = _shell(container.tag, container.nsmap, doctype)
+        shell.extend(children[start:start + size])
+        shells.append(shell)
+    marker = "lxmlmeld-{}".format(os.urandom(16).hex())
+    container.append(etree.Comment(marker))
+    pool = executor or parallel
+    try:
+        bodies = list(pool.map(lambda s: _serialise_shell(s, kwargs), shells))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    head, tail = etree.tostring(doc, **kwargs).split(
+        "<!--{}-->".format(marker).encode("ascii")
+    )
+    return [head] + bodies + [tail]
+
+
+def _write_chunks(file, chunks):
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "wb") as fh:
+            fh.writelines(chunks)
+        return None
+    sink = file if hasattr(file, "write") else _Writer(file)
+    for chunk in chunks:
+        sink.write(chunk)
+    return sink.written if sink is not file else None
+
+
+_MELD_PREFIX = "{%s}" % NS
+_XHTML_PREFIX = "{http://www.w3.org/1999/xhtml}"
+# Void elements that libxml2 would write with an end tag
+_HTML5_UNKNOWN_VOID = tuple(
+    "{*}" + tag for tag in ("embed", "keygen", "source", "track", "wbr")
+)
+_HTML5_VOID = frozenset((
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen",
+    "link", "meta", "param", "source", "track", "wbr",
+))
+# Elements whose text is written as it is
+_HTML5_RAW = frozenset(("script", "style"))
+# Elements whose whitespace is kept when minifying
+_HTML5_PRESERVE = frozenset(("pre", "textarea", "script", "style"))
+# Elements that whitespace next to can be dropped when minifying, as it
+# isn't rendered; whitespace next to anything else (including unknown and
+# custom elements, comments and the like) is kept
+_HTML5_BLOCK = frozenset((
+    "address", "article", "aside", "base", "blockquote", "body", "caption",
+    "center", "col", "colgroup", "dd", "details", "dialog", "dir", "div",
+    "dl", "dt", "fieldset", "figcaption", "figure", "footer", "form",
+    "frame", "frameset", "h1", "h2", "h3", "h4", "h5", "h6", "head",
+    "header", "hgroup", "hr", "html", "legend", "li", "link", "main", "menu",
+    "meta", "nav", "noframes", "ol", "optgroup", "option", "p", "pre",
+    "section", "summary", "table", "tbody", "td", "tfoot", "th", "thead",
+    "title", "tr", "ul",
+))
+# Attributes libxml2 writes as just their name, whatever their value
+_HTML_BOOLEAN = frozenset((
+    "checked", "compact", "declare", "defer", "disabled", "ismap",
+    "multiple", "nohref", "noresize", "noshade", "nowrap", "readonly",
+    "selected",
+))
+_HTML5_UNQUOTED = re.compile(r"[^ \t\n\r\f\"'=<>`]+\Z")
+_HTML5_WHITESPACE = re.compile(r"[ \t\n\r\f]+")
+
+
+def _html5_name(name, ele):
+    if name[0] != "{":
+        return name
+    ns, local = name[1:].split("}", 1)
+    if ns == "http://www.w3.org/XML/1998/namespace":
+        return "xml:" + local
+    for prefix, uri in ele.nsmap.items():
+        if uri == ns and prefix:
+            return "{}:{}".format(prefix, local)
+    return local
+
+
+def _write_html5(ele, out, preserve=False):
+    # Appends ele (but not its tail), minified, to out as a list of str.
+    # meld elements and attributes are left out as they go.
+    append = out.append
+    name = ele.tag
+    if name[0] == "{":
+        name = _html5_name(name, ele)
+    append("<" + name)
+    for k, v in ele.items():
+        if k[0] == "{":
+            if k.startswith(_MELD_PREFIX):
+                continue
+            k = _html5_name(k, ele)
+        if not v or k in _HTML_BOOLEAN:
+            append(" " + k)
+            continue
+        v = v.replace("&", "&amp;")
+        if _HTML5_UNQUOTED.match(v):
+            append(" {}={}".format(k, v))
+        else:
+            append(' {}="{}"'.format(k, v.replace('"', "&quot;")))
+    append(">")
 
-def _parser(parser_cls=etree.XMLParser):
-    parser = parser_cls()
-    parser.set_element_class_lookup(
-        etree.ElementDefaultClassLookup(element=Element)
+    preserve = preserve or name in _HTML5_PRESERVE
+    raw = name in _HTML5_RAW
+    # Whether the boundary before the current piece of text is inline
+    inline = name not in _HTML5_BLOCK
+    text = ele.text
+    for child in ele:
+        tag = child.tag
+        if not isinstance(tag, str):
+            child_inline = True
+        elif tag[0] == "{":
+            if tag.startswith(_MELD_PREFIX):
+                continue
+            child_inline = _html5_name(tag, child) not in _HTML5_BLOCK
+        else:
+            child_inline = tag not in _HTML5_BLOCK
+        _write_html5_text(out, text, preserve, raw, inline and child_inline)
+        if tag is etree.Comment:
+            append("<!--{}-->".format(child.text or ""))
+        elif tag is etree.ProcessingInstruction:
+            append("<?{}>".format(
+                " ".join(filter(None, (child.target, child.text)))
+            ))
+        elif tag is etree.Entity:
+            append(child.text)
+        else:
+            _write_html5(child, out, preserve)
+        text, inline = child.tail, child_inline
+    _write_html5_text(
+        out, text, preserve, raw, inline and name not in _HTML5_BLOCK
     )
+    # Anything inside a void element has been written after it
+    if name not in _HTML5_VOID:
+        append("</{}>".format(name))
+
+
+def _write_html5_text(out, text, preserve, raw, inline):
+    if not text:
+        return
+    if not preserve:
+        text = _HTML5_WHITESPACE.sub(" ", text)
+        if text == " " and not inline:
+            return
+    if not raw:
+        text = text.replace("&", "&amp;").replace("<", "&lt;") \
+            .replace(">", "&gt;")
+    out.append(text)
+
+
+def _parser(parser_cls=etree.XMLParser, element=Element):
+    try:
+        cache = _local.parsers
+    except AttributeError:
+        cache = _local.parsers = {}
+    parser = cache.get((parser_cls, element))
+    if parser is None:
+        parser = cache[(parser_cls, element)] = parser_cls()
+        parser.set_element_class_lookup(
+            etree.ElementDefaultClassLookup(element=element)
+        )
     return parser
 
 
-def _check_tree(tree):
+def _check_melds(tree, html=False):
+    # Checks for duplicate meld:ids in one pass over just the elements that
+    # have one. The HTML parser deliberately doesn't parse namespaces, so for
+    # HTML this also moves the meld:id attributes into the correct namespace.
     seen = set()
-    for id in tree.xpath("//@meld:id", namespaces={"meld": NS}):
+    for id in _xpath(_FIND_HTML_MELD_IDS if html else _FIND_MELD_IDS)(tree):
         if id in seen:
             raise ValueError("Duplicate meld:id: {}".format(id))
+        ele, id = id.getparent(), str(id)
         seen.add(id)
+        if html:
+            del ele.attrib["meld:id"]
+            ele.set(_MELD_ID, id)
 
 
 def parse_xml(xml):
@@ -406,7 +1287,8 @@ def parse_xml(xml):
     Parses XML from a file-like object. Returns the root element.
     """
     t = etree.parse(xml, _parser()).getroot()
-    _check_tree(t)
+    _check_melds(t)
+    _account("parse", t)
     return t
 
 
@@ -415,26 +1297,18 @@ def parse_xmlstring(xml):
     Parses a str or unicode of XML. Returns the root element.
     """
     t = etree.fromstring(xml, _parser())
-    _check_tree(t)
+    _check_melds(t)
+    _account("parse", t)
     return t
 
 
-def _fix_html(tree):
-    # The HTML parser deliberately doesn't parse namespaces, so this phase
-    # moves the meld:id attributes into the correct namespace.
-    qn = etree.QName(NS, "id").text
-    for ele in tree.iter():
-        if "meld:id" in ele.attrib:
-            ele.set(qn, ele.attrib.pop("meld:id"))
-
-
 def parse_html(html):
     """
     Parses HTML from a file-like object. Returns the root element.
     """
     t = etree.parse(html, _parser(etree.HTMLParser)).getroot()
-    _fix_html(t)
-    _check_tree(t)
+    _check_melds(t, html=True)
+    _account("parse", t)
     return t
 
 
@@ -443,6 +1317,103 @@ def parse_htmlstring(html):
     Parses a str or unicode of HTML. Returns the root element.
     """
     t = etree.fromstring(html, _parser(etree.HTMLParser))
-    _fix_html(t)
-    _check_tree(t)
+    _check_melds(t, html=True)
+    _account("parse", t)
     return t
+
+
+def warmup(templates=(), html=False):
+    """
+    Does the one-off work of a first parse and render ahead of time: creating
+    the parsers, compiling the XPath queries used internally and running the
+    serialiser. This is only done for the calling thread. Any templates given
+    are parsed (as HTML if html is true, otherwise as XML) and returned as a
+    list of root elements; each can be a str or a file-like object.
+    """
+    for expr in (_FIND_MELD, _FIND_MELDS, _FIND_MELD_IDS, _FIND_HTML_MELD_IDS,
+                 _FIND_OWN_ELEMENTS, _FIND_OWN_ATTRIBUTES):
+        _xpath(expr)
+    doc = parse_htmlstring("<p meld:id='p'></p>")
+    doc.fillmelds(p="")
+    doc.write_htmlstring()
+    doc = parse_xmlstring("<p xmlns:meld='{}' meld:id='p'/>".format(NS))
+    doc.fillmelds(p="")
+    doc.write_xmlstring()
+    doc.write_xhtmlstring()
+    if html:
+        parse, parse_string = parse_html, parse_htmlstring
+    else:
+        parse, parse_string = parse_xml, parse_xmlstring
+    return [
+        parse_string(t) if isinstance(t, (str, bytes)) else parse(t)
+        for t in templates
+    ]
+
+
+class MeldParser(object):
+    """
+    Parses a template incrementally, as its data arrives. Pass each chunk
+    of data (bytes or str) to feed() and call close() at the end to get the
+    root element, as parse_xml() or (if html is true) parse_html() would
+    return. The meld:id attributes are fixed up and checked for duplicates
+    as each element is parsed, so errors are raised by feed() as soon as
+    they are found.
+    """
+
+    def __init__(self, html=False):
+        self.html = html
+        cls = etree.HTMLPullParser if html else etree.XMLPullParser
+        self._parser = cls(events=("start",))
+        self._parser.set_element_class_lookup(
+            etree.ElementDefaultClassLookup(element=Element)
+        )
+        self._seen = set()
+
+    def _process(self):
+        for _, ele in self._parser.read_events():
+            if self.html and "meld:id" in ele.attrib:
+                ele.set(_MELD_ID, ele.attrib.pop("meld:id"))
+            id = ele.get(_MELD_ID)
+            if id is not None:
+                if id in self._seen:
+                    raise ValueError("Duplicate meld:id: {}".format(id))
+                self._seen.add(id)
+
+    def feed(self, data):
+        """
+        Parses the next chunk of data.
+        """
+        self._parser.feed(data)
+        self._process()
+
+    def close(self):
+        """
+        Finishes parsing and returns the root element.
+        """
+        root = self._parser.close()
+        self._process()
+        _account("parse", root)
+        return root
+
+
+def parse_chunks(chunks, html=False):
+    """
+    Parses XML (or HTML if html is true) from an iterable of chunks of
+    bytes or str, such as a streamed HTTP response. Returns the root
+    element.
+    """
+    parser = MeldParser(html=html)
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
+async def parse_async(chunks, html=False):
+    """
+    As parse_chunks, but takes an asynchronous iterable of chunks, so that
+    parsing is done while waiting for the rest of the data.
+    """
+    parser = MeldParser(html=html)
+    async for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
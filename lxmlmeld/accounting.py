@@ -0,0 +1,162 @@
+import tracemalloc
+
+from lxml import etree
+
+from lxmlmeld import _local
+
+# Rough sizes of libxml2's node structures on a 64-bit platform, used to
+# estimate how much memory the C side of a tree is using.
+NODE_SIZE = 120
+ATTRIBUTE_SIZE = 96
+
+
+class RenderLimitExceeded(MemoryError):
+    """
+    Raised when a render goes over one of the limits of its RenderAccount.
+    """
+
+
+def _measure(nodes):
+    # Returns the node count and estimated libxml2 bytes of some trees
+    count = size = 0
+    for tree in nodes:
+        for ele in tree.iter():
+            count += 1
+            size += NODE_SIZE
+            for text in (ele.text, ele.tail):
+                if text:
+                    count += 1
+                    size += NODE_SIZE + len(text)
+            for k, v in ele.attrib.items():
+                count += 1
+                size += ATTRIBUTE_SIZE + NODE_SIZE + len(k) + len(v)
+    return count, size
+
+
+class RenderAccount(object):
+    """
+    Records the nodes created by lxmlmeld calls made (in the same thread)
+    while it is in use as a context manager: parsing, clone(), repeat(),
+    content(structure=True) and the write_* calls (which also record the
+    size of their output in bytes, where known; text output is counted as
+    UTF-8).
+
+    If max_nodes or max_bytes are given, a RenderLimitExceeded is raised as
+    soon as either the number of nodes or the estimated memory used goes
+    over the limit. If trace_python is true, Python allocations are tracked
+    with tracemalloc too and count towards max_bytes.
+
+    Accounts can be nested (eg. one per template inside one per request);
+    an inner account's usage is also added to the outer one.
+    """
+
+    def __init__(self, name=None, max_nodes=None, max_bytes=None,
+                 trace_python=False):
+        self.name = name
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.trace_python = trace_python
+        self.nodes = 0
+        self.estimated_bytes = 0
+        self.output_bytes = 0
+        self.python_bytes = 0
+        self.python_peak = 0
+        self.operations = {}
+        self._parent = None
+        self._active = False
+        self._started_tracing = False
+        self._python_start = 0
+
+    def __enter__(self):
+        self._parent = getattr(_local, "account", None)
+        _local.account = self
+        self._active = True
+        if self.trace_python:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            self._python_start = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.account = self._parent
+        self._active = False
+        if self.trace_python:
+            self._update_python()
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+        return False
+
+    def _update_python(self):
+        if not tracemalloc.is_tracing():
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        self.python_bytes = current - self._python_start
+        self.python_peak = max(self.python_peak, peak - self._python_start)
+
+    def add(self, operation, nodes, output=None):
+        """
+        Records that operation created the given elements (or lists of
+        elements), and optionally produced output bytes of output. Raises
+        RenderLimitExceeded if this takes the account over its limits.
+        """
+        if isinstance(nodes, etree._Element):
+            nodes = [nodes]
+        count, size = _measure(nodes)
+        self._add(operation, count, size, output)
+
+    def _add(self, operation, count, size, output):
+        stats = self.operations.setdefault(
+            operation,
+            {"calls": 0, "nodes": 0, "estimated_bytes": 0, "output_bytes": 0}
+        )
+        stats["calls"] += 1
+        stats["nodes"] += count
+        stats["estimated_bytes"] += size
+        self.nodes += count
+        self.estimated_bytes += size
+        if output is not None:
+            stats["output_bytes"] += output
+            self.output_bytes += output
+        if self._parent is not None:
+            self._parent._add(operation, count, size, output)
+        self.check(operation)
+
+    def check(self, operation=None):
+        """
+        Raises RenderLimitExceeded if the account is over its limits.
+        """
+        where = " (after {})".format(operation) if operation else ""
+        label = " {}".format(self.name) if self.name else ""
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise RenderLimitExceeded(
+                "Render{} created {} nodes, over the limit of {}{}".format(
+                    label, self.nodes, self.max_nodes, where
+                )
+            )
+        if self.max_bytes is not None:
+            if self.trace_python and self._active:
+                self._update_python()
+            used = self.estimated_bytes + max(self.python_bytes, 0)
+            if used > self.max_bytes:
+                raise RenderLimitExceeded(
+                    "Render{} used about {} bytes, over the limit of "
+                    "{}{}".format(label, used, self.max_bytes, where)
+                )
+
+    def report(self):
+        """
+        Returns a dict summarising what has been recorded.
+        """
+        if self.trace_python and self._active:
+            self._update_python()
+        return {
+            "name": self.name,
+            "nodes": self.nodes,
+            "estimated_bytes": self.estimated_bytes,
+            "output_bytes": self.output_bytes,
+            "python_bytes": self.python_bytes,
+            "python_peak": self.python_peak,
+            "operations": {k: dict(v) for k, v in self.operations.items()},
+        }
@@ -0,0 +1,408 @@
+import os
+import re
+import struct
+import zlib
+
+from lxml import etree
+
+from lxmlmeld import _ascii_compatible, _Compressing, \
+    _serialise_shell, _shell, _strip_own_ns, _write_chunks, doctypes
+
+# Where each meld's output is split up: before its start tag, after its
+# start tag, before its end tag and after its end tag.
+_BEFORE, _START, _END, _AFTER = b"ABCD"
+
+# The formats whose output can be made by joining separately compressed
+# pieces: the header, the initial checksum, the checksum function and a
+# function giving the trailer from the checksum and length.
+_FORMATS = {
+    "gzip": (
+        b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff", 0, zlib.crc32,
+        lambda crc, size: struct.pack("<II", crc, size & 0xffffffff)
+    ),
+    "deflate": (
+        b"\x78\x9c", 1, zlib.adler32,
+        lambda adler, size: struct.pack(">I", adler)
+    ),
+}
+
+
+class _Meld(object):
+    # What's needed to serialise a meld again, without the original tree
+    def __init__(self, ele):
+        self.tag = ele.tag
+        self.attrib = dict(ele.attrib)
+        self.nsmap = ele.nsmap
+        parent = ele.getparent()
+        if parent is None:
+            self.own_nsmap = self.nsmap
+            self.parent = None
+        else:
+            inherited = parent.nsmap
+            self.own_nsmap = {
+                k: v for k, v in self.nsmap.items() if inherited.get(k) != v
+            }
+            self.parent = (parent.tag, inherited)
+        # Empty melds aren't split at their content, as serialising them
+        # with something in them would change how their tags are written
+        self.empty = ele.text is None and not len(ele)
+
+
+class OverlayTemplate(object):
+    """
+    A template prepared for rendering without being copied or changed.
+
+    The template is serialised once, split up at the melds it contains.
+    Each call to overlay() then gives an Overlay, which records changes
+    to melds and writes the output by putting those changes between the
+    prepared pieces. Nothing is shared between renders except read-only
+    data, so any number of threads can render from the same
+    OverlayTemplate at once.
+
+    method is one of "xml", "xhtml" or "html" (ValueError is raised for
+    others, including "html5"), and any other arguments are passed on to
+    the matching write_*string call (eg. doctype or encoding). The template
+    isn't referenced afterwards, so later changes to it have no effect.
+
+    Values that aren't text are converted with the formatter of root's
+    class, unless content() is given another. The output is the same as
+    filling in a clone() of the template and serialising it, except that
+    namespace declarations left unused by a change are still written.
+    """
+
+    def __init__(self, root, method="html", **kwargs):
+        if method not in ("xml", "xhtml", "html"):
+            raise ValueError("Unsupported method: {}".format(method))
+        encoding = kwargs.get("encoding")
+        if not _ascii_compatible(encoding):
+            raise ValueError("Unsupported encoding: {}".format(encoding))
+        self.method = method
+        self.formatter = type(root).formatter
+        self._kwargs = {
+            "method": "html" if method == "html" else "xml",
+            "encoding": encoding,
+        }
+        self._doctype = doctypes.xhtml.encode("ascii") \
+            if method == "xhtml" else b""
+
+        doc = root.clone()
+        eles = []
+        self._index = {}
+        for ele in doc.findmelds():
+            self._index.setdefault(ele.meldid(), len(eles))
+            eles.append(ele)
+        _strip_own_ns(doc)
+        self._melds = [_Meld(ele) for ele in eles]
+
+        token = os.urandom(8).hex()
+        for i, ele in enumerate(eles):
+            marker = "{}:{}:".format(token, i)
+            if not self._melds[i].empty:
+                start = etree.Comment(marker + "B")
+                start.tail, ele.text = ele.text, None
+                ele.insert(0, start)
+                ele.append(etree.Comment(marker + "C"))
+            if ele is not doc:
+                ele.addprevious(etree.Comment(marker + "A"))
+                after = etree.Comment(marker + "D")
+                after.tail, ele.tail = ele.tail, None
+                ele.addnext(after)
+
+        write = getattr(doc, "write_{}string".format(method))
+        parts = re.split(
+            "<!--{}:([0-9]+):([ABCD])-->".format(token).encode("ascii"),
+            write(**kwargs)
+        )
+        # Alternating static bytes and (meld number, position) pairs
+        self._parts = [parts[0]]
+        for i in range(1, len(parts), 3):
+            self._parts.append((int(parts[i]), parts[i + 1][0]))
+            self._parts.append(parts[i + 2])
+
+        self._compressed = None
+
+        # What comes before the root element's start tag, in case the root
+        # element has to be written again
+        if eles and eles[0] is doc:
+            if self._melds[0].empty:
+                alone = etree.tostring(
+                    doc, xml_declaration=False, **self._kwargs
+                )
+                self._prologue = self._parts[0][:-len(alone)]
+            else:
+                self._prologue = self._parts[0][:self._parts[0].rindex(b"<")]
+
+    def overlay(self):
+        """
+        Returns a new Overlay for rendering this template once.
+        """
+        return Overlay(self)
+
+    def _compressed_parts(self):
+        # The static parts, each compressed on its own as raw deflate data
+        # that can be put between other pieces of compressed data
+        if self._compressed is None:
+            compressed = []
+            for n, part in enumerate(self._parts):
+                if n % 2 or not part:
+                    compressed.append(b"")
+                    continue
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                compressed.append(
+                    compressor.compress(part) +
+                    compressor.flush(zlib.Z_SYNC_FLUSH)
+                )
+            self._compressed = compressed
+        return self._compressed
+
+    def _element(self, meld, attributes, content, structure, formatter,
+                 whole):
+        # Serialises meld with its attributes updated and the given content.
+        # If whole is false only the start tag is returned.
+        attrib = dict(meld.attrib)
+        attrib.update(attributes)
+        if meld.parent is None:
+            ele = etree.fromstring(self._doctype + etree.tostring(
+                etree.Element(meld.tag, attrib, nsmap=meld.own_nsmap)
+            ))
+        else:
+            shell = _shell(meld.parent[0], meld.parent[1], self._doctype)
+            ele = etree.SubElement(shell, meld.tag, attrib,
+                                   nsmap=meld.own_nsmap)
+        if not whole:
+            content, structure = "x", False
+        _fill(ele, content, structure, formatter)
+        if self._doctype and ele.text == "" and not len(ele):
+            # write_xhtml() re-parses what it writes, which loses empty text
+            ele.text = None
+        if meld.parent is None:
+            ret = etree.tostring(ele, xml_declaration=False, **self._kwargs)
+        else:
+            ret = _serialise_shell(shell, self._kwargs)
+        return ret if whole else ret[:ret.rindex(b">x</") + 1]
+
+    def _content(self, meld, value, structure, formatter):
+        shell = _shell(meld.tag, meld.nsmap, self._doctype)
+        _fill(shell, value, structure, formatter)
+        return _serialise_shell(shell, self._kwargs)
+
+    def _replacement(self, meld, value, structure):
+        shell = _shell(meld.parent[0], meld.parent[1], self._doctype)
+        _fill(shell, value, structure, self.formatter)
+        return _serialise_shell(shell, self._kwargs)
+
+
+def _is_empty(value, structure):
+    # Whether _fill() would leave an element with nothing in it, which can
+    # change how its tags are written
+    if isinstance(value, etree._Element):
+        return False
+    if isinstance(value, (list, tuple)):
+        return not value
+    if structure:
+        xml = etree.XML("<dispose>{}</dispose>".format(value))
+        return not xml.text and not len(xml)
+    return value is None or value in ("", b"")
+
+
+def _fill(ele, value, structure, formatter):
+    # Sets the content of a new element, as Element.content() would
+    if isinstance(value, etree._Element):
+        value = [value]
+    if isinstance(value, (list, tuple)):
+        ele.extend(node.__deepcopy__({}) for node in value)
+    elif structure:
+        xml = etree.XML("<dispose>{}</dispose>".format(value))
+        ele.text = xml.text
+        ele.extend(xml)
+    elif value is None or isinstance(value, (str, bytes)):
+        ele.text = value
+    else:
+        ele.text = formatter(value)
+
+
+class Overlay(object):
+    """
+    The changes for one render of an OverlayTemplate. The content(),
+    attributes(), replace() and fillmelds() calls take a meld:id and
+    otherwise behave as the Element calls of the same names would. An
+    Overlay should only be used by one thread.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self._attributes = {}
+        self._content = {}
+        self._emptied = set()
+        self._replace = {}
+
+    def _find(self, name):
+        try:
+            return self.template._index[name]
+        except KeyError:
+            raise KeyError(name)
+
+    def content(self, name, text, structure=False, formatter=None):
+        """
+        Sets the content of the meld with meld:id name. Raises KeyError if
+        there's no such meld.
+        """
+        i = self._find(name)
+        self._content[i] = (
+            text, structure, formatter or self.template.formatter
+        )
+        if _is_empty(text, structure):
+            self._emptied.add(i)
+        else:
+            self._emptied.discard(i)
+
+    def attributes(self, name, **kwargs):
+        """
+        Sets attributes on the meld with meld:id name. Raises KeyError if
+        there's no such meld.
+        """
+        self._attributes.setdefault(self._find(name), {}).update(kwargs)
+
+    def replace(self, name, text, structure=False):
+        """
+        Replaces the meld with meld:id name. Raises KeyError if there's no
+        such meld, and ValueError if it is the root element.
+        """
+        i = self._find(name)
+        meld = self.template._melds[i]
+        if meld.parent is None:
+            raise ValueError("Can't replace the root element")
+        self._replace[i] = self.template._replacement(meld, text, structure)
+
+    def fillmelds(self, **kwargs):
+        """
+        Calls content() for each kwarg. Returns the list of argument names
+        that don't correspond to meld:ids.
+        """
+        missing = []
+        for k, v in kwargs.items():
+            if k in self.template._index:
+                self.content(k, v)
+            else:
+                missing.append(k)
+        return missing
+
+    def _rebuild(self, i, whole):
+        content, structure, formatter = self._content.get(
+            i, (None, False, self.template.formatter)
+        )
+        if whole and i not in self._content:
+            content = []
+        return self.template._element(
+            self.template._melds[i], self._attributes.get(i, {}),
+            content, structure, formatter, whole
+        )
+
+    def chunks(self):
+        """
+        Returns the output as a list of bytes strings.
+        """
+        return [data for data, n in self._pieces()]
+
+    def _pieces(self):
+        # The output as a list of (bytes, n) where n is the index in the
+        # template's parts of an unchanged static part, otherwise None
+        template = self.template
+        parts = template._parts
+        changed = self._attributes.keys() | self._content.keys()
+        if template._melds and template._melds[0].parent is None and (
+                template._melds[0].empty and 0 in changed or
+                0 in self._emptied):
+            # An empty root element has no markers, and one that has been
+            # emptied may be written differently, so is written whole
+            return [(template._prologue, None), (self._rebuild(0, True), None)]
+
+        ret = []
+        skip_to = None
+        for n, part in enumerate(parts):
+            if n % 2 == 0:
+                if skip_to is None:
+                    ret.append((part, n))
+                continue
+            if skip_to is not None:
+                if part == skip_to:
+                    skip_to = None
+                continue
+            i, where = part
+            meld = template._melds[i]
+            if where == _BEFORE:
+                if i in self._replace:
+                    ret.append((self._replace[i], None))
+                    skip_to = (i, _AFTER)
+                elif meld.empty and i in changed or i in self._emptied:
+                    # Written whole, as emptying an element can change how
+                    # its tags are written
+                    ret.append((self._rebuild(i, True), None))
+                    skip_to = (i, _AFTER)
+            elif where == _START:
+                if i in self._attributes:
+                    # Swap the static start tag for a rebuilt one
+                    if meld.parent is None:
+                        ret[-1] = (template._prologue, None)
+                    else:
+                        ret.pop()
+                    ret.append((self._rebuild(i, False), None))
+                if i in self._content:
+                    text, structure, formatter = self._content[i]
+                    ret.append((
+                        template._content(meld, text, structure, formatter),
+                        None
+                    ))
+                    skip_to = (i, _END)
+        return ret
+
+    def compressed_chunks(self, format="gzip"):
+        """
+        Returns the output compressed with format ("gzip" or "deflate") as
+        a list of bytes strings. The static parts of the template are only
+        compressed once, the first time they are needed, and reused after
+        that; only the changes are compressed for each render.
+        """
+        header, checksum, update, trailer = _FORMATS[format]
+        static = self.template._compressed_parts()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        ret = [header]
+        size = 0
+        changes = []
+        for data, n in self._pieces():
+            checksum = update(data, checksum)
+            size += len(data)
+            if n is None:
+                changes.append(data)
+                continue
+            if changes:
+                # A full flush stops anything compressed later referring
+                # back to these changes, as the static parts go in between
+                ret.append(
+                    compressor.compress(b"".join(changes)) +
+                    compressor.flush(zlib.Z_FULL_FLUSH)
+                )
+                changes = []
+            ret.append(static[n])
+        ret.append(compressor.compress(b"".join(changes)) + compressor.flush())
+        ret.append(trailer(checksum, size))
+        return ret
+
+    def write(self, file=None, compress=None):
+        """
+        Writes the output to file, which can be anything the write_*
+        calls accept. If file is None the output is returned as bytes.
+        compress is as for the write_* calls; for "gzip" and "deflate" the
+        output is made as for compressed_chunks().
+        """
+        if compress in _FORMATS:
+            chunks = self.compressed_chunks(compress)
+        elif compress:
+            with _Compressing(file, compress) as out:
+                _write_chunks(out, self.chunks())
+            return out.result
+        else:
+            chunks = self.chunks()
+        if file is None:
+            return b"".join(chunks)
+        return _write_chunks(file, chunks)
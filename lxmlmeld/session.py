@@ -0,0 +1,150 @@
+from lxml import etree
+
+from lxmlmeld import _parser
+
+# The methods a session can use, each with a write_*string call
+_METHODS = ("xml", "xhtml", "html", "html5")
+
+
+class RenderSession(object):
+    """
+    Keeps a filled-in document between renders and tracks which melds have
+    been changed, so that only the changed parts need to be sent on again.
+
+    Make changes through the session's content(), attributes(), replace()
+    and fillmelds() calls rather than on the elements directly. render()
+    gives the whole document; patches() gives just the melds changed since
+    the last render() or patches() call. method is one of "xml", "xhtml",
+    "html" or "html5", and patches are serialised the same way as render()
+    would.
+    """
+
+    def __init__(self, root, method="html", encoding=None):
+        if method not in _METHODS:
+            raise ValueError("Unknown method: {}".format(method))
+        self.root = root
+        self.method = method
+        self.encoding = encoding
+        self._dirty = {}
+        self._replaced = []
+
+    def _find(self, name):
+        ele = self.root.findmeld(name)
+        if ele is None:
+            raise KeyError(name)
+        return ele
+
+    def content(self, name, text, structure=False):
+        """
+        Calls content() on the element with meld:id name. Raises KeyError
+        if there's no such element.
+        """
+        ele = self._find(name)
+        if not structure and isinstance(text, str) and not len(ele) and \
+                ele.text == text:
+            return
+        ele.content(text, structure=structure)
+        self._dirty[name] = ele
+
+    def attributes(self, name, **kwargs):
+        """
+        Calls attributes() on the element with meld:id name. Raises KeyError
+        if there's no such element.
+        """
+        ele = self._find(name)
+        if all(ele.get(k) == v for k, v in kwargs.items()):
+            return
+        ele.attributes(**kwargs)
+        self._dirty[name] = ele
+
+    def replace(self, name, text, structure=False):
+        """
+        Calls replace() on the element with meld:id name. Raises KeyError
+        if there's no such element. As the meld is removed from the document
+        it can't be changed again afterwards.
+        """
+        ele = self._find(name)
+        if ele.getparent() is None:
+            return
+        fragment = self._serialise_replacement(text, structure)
+        ele.replace(text, structure=structure)
+        self._dirty.pop(name, None)
+        self._replaced.append((name, fragment))
+
+    def fillmelds(self, **kwargs):
+        """
+        Calls content() for each kwarg as for Element.fillmelds(). Returns
+        the list of argument names that don't correspond to meld:ids.
+        """
+        missing = []
+        for k, v in kwargs.items():
+            try:
+                self.content(k, v)
+            except KeyError:
+                missing.append(k)
+        return missing
+
+    def render(self, *args, **kwargs):
+        """
+        Returns the whole document as bytes using the write_*string call for
+        the session's method, passing on any arguments. Pending changes are
+        treated as sent.
+        """
+        self._dirty = {}
+        self._replaced = []
+        write = getattr(self.root, "write_{}string".format(self.method))
+        return write(*args, **kwargs)
+
+    def _write(self, ele):
+        # Serialises ele (which mustn't have a tail) as a fragment, using the
+        # write_*string call for the session's method
+        write = getattr(ele, "write_{}string".format(self.method))
+        return write(encoding=self.encoding, fragment=True)
+
+    def _serialise(self, ele):
+        copy = ele.clone()
+        copy.tail = None
+        return self._write(copy)
+
+    def _serialise_replacement(self, text, structure):
+        # Serialise whatever replace() would insert, without the wrapper
+        if isinstance(text, etree._Element):
+            text = [text]
+        wrapper = etree.fromstring("<dispose/>", _parser())
+        if isinstance(text, (list, tuple)):
+            wrapper.extend(node.__deepcopy__({}) for node in text)
+        elif structure:
+            xml = etree.XML("<dispose>{}</dispose>".format(text))
+            wrapper.text = xml.text
+            wrapper.extend(xml)
+        else:
+            wrapper.text = text
+        if not wrapper.text and not len(wrapper):
+            return b""
+        ret = self._write(wrapper)
+        start, end = (">", "</") if isinstance(ret, str) else (b">", b"</")
+        return ret[ret.index(start) + 1:ret.rindex(end)]
+
+    def patches(self):
+        """
+        Returns a list of (meld_id, fragment) pairs, one for each meld changed
+        since the last call, where fragment is the serialised element
+        (including its own tag). If a meld and one containing it have both
+        changed only the outer one is given. For replaced melds the fragment
+        is the serialised replacement.
+        """
+        dirty, self._dirty = self._dirty, {}
+        replaced, self._replaced = self._replaced, []
+        changed = set(dirty.values())
+        ret = []
+        for name, ele in dirty.items():
+            ancestors = list(ele.iterancestors())
+            if ele is not self.root and self.root not in ancestors:
+                # No longer in the document (eg. an outer meld's content
+                # was set afterwards)
+                continue
+            if any(a in changed for a in ancestors):
+                continue
+            ret.append((name, self._serialise(ele)))
+        ret.extend(replaced)
+        return ret
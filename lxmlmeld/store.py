@@ -0,0 +1,127 @@
+import os
+
+from lxml import etree
+
+from lxmlmeld import _FIND_MELDS, _MELD_ID, _check_melds, _parser, _xpath, \
+    parse_html, parse_htmlstring, parse_xml, parse_xmlstring
+
+
+class TemplateStore(object):
+    """
+    Holds a set of templates in a compact serialised form, for servers that
+    load their templates once and then fork worker processes.
+
+    Templates are parsed and checked when they are added (so errors show up
+    in the parent process) and then kept only as bytes, which forked workers
+    share copy-on-write. If shared is true, share() copies all the templates
+    into a single multiprocessing.shared_memory block instead. A worker only
+    builds a tree for a template the first time it asks for it with get().
+    HTML templates are kept as HTML, so that anything the HTML parser
+    accepts (eg. inline SVG using undeclared prefixes) can be read back.
+    """
+
+    def __init__(self, shared=False):
+        self.shared = shared
+        self._sources = {}
+        self._index = {}
+        self._shm = None
+        self._owner = None
+        self._trees = {}
+        self._html = set()
+
+    def _add(self, name, root, html=False):
+        if self._shm is not None:
+            raise ValueError("Can't add templates after share()")
+        if html:
+            # The meld:ids are put back as the HTML parser reads them
+            root = root.__deepcopy__({})
+            for ele in _xpath(_FIND_MELDS)(root):
+                ele.set("meld:id", ele.attrib.pop(_MELD_ID))
+            etree.cleanup_namespaces(root)
+            self._sources[name] = etree.tostring(
+                root, method="html", encoding="UTF-8"
+            )
+            self._html.add(name)
+        else:
+            self._sources[name] = etree.tostring(root, encoding="UTF-8")
+            self._html.discard(name)
+        self._trees.pop(name, None)
+
+    def add_xml(self, name, xml):
+        """
+        Adds a template from XML, which can be a file-like object or a str.
+        """
+        parse = parse_xmlstring if isinstance(xml, (str, bytes)) else \
+            parse_xml
+        self._add(name, parse(xml))
+
+    def add_html(self, name, html):
+        """
+        Adds a template from HTML, which can be a file-like object or a str.
+        """
+        parse = parse_htmlstring if isinstance(html, (str, bytes)) else \
+            parse_html
+        self._add(name, parse(html), html=True)
+
+    def share(self):
+        """
+        Moves all the templates into one shared memory block. Call this in
+        the parent process before forking. Does nothing unless the store was
+        created with shared set to true.
+        """
+        if not self.shared or self._shm is not None:
+            return
+        from multiprocessing import shared_memory
+        size = sum(len(src) for src in self._sources.values())
+        self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self._owner = os.getpid()
+        offset = 0
+        for name, src in self._sources.items():
+            self._shm.buf[offset:offset + len(src)] = src
+            self._index[name] = (offset, len(src))
+            offset += len(src)
+        self._sources = {}
+
+    def close(self):
+        """
+        Releases the shared memory block, if any. The block is destroyed
+        when it is closed by the process that created it.
+        """
+        if self._shm is not None:
+            self._shm.close()
+            if self._owner == os.getpid():
+                self._shm.unlink()
+            self._shm = None
+        self._index = {}
+        self._trees = {}
+
+    def names(self):
+        """
+        Returns a list of the names of the templates held.
+        """
+        return list(self._index or self._sources)
+
+    def _source(self, name):
+        if self._shm is not None:
+            offset, length = self._index[name]
+            return bytes(self._shm.buf[offset:offset + length])
+        return self._sources[name]
+
+    def get(self, name):
+        """
+        Returns a new copy of the named template's root element, which can
+        be filled in and serialised as normal. Raises KeyError if there is
+        no such template.
+        """
+        tree = self._trees.get(name)
+        if tree is None:
+            src = self._source(name)
+            if name in self._html:
+                tree = etree.fromstring(
+                    src.decode("utf-8"), _parser(etree.HTMLParser)
+                )
+                _check_melds(tree, html=True)
+            else:
+                tree = etree.fromstring(src, _parser())
+            self._trees[name] = tree
+        return tree.clone()
@@ -0,0 +1,110 @@
+import os
+import tempfile
+import unittest
+from io import StringIO
+from unittest import TestCase
+
+from lxmlmeld import parse_xmlstring
+from lxmlmeld.accounting import RenderAccount, RenderLimitExceeded
+
+XML = "<a xmlns:meld='http://www.plope.com/software/meld3'>" \
+    "<r meld:id='r'><c meld:id='c'/></r></a>"
+
+
+class RenderAccountTests(TestCase):
+    def test_records_operations(self):
+        with RenderAccount("report") as account:
+            doc = parse_xmlstring(XML)
+            for ele, data in doc.repeat(range(3), "r"):
+                ele.findmeld("c").content("<b>x</b>", structure=True)
+            out = doc.write_xmlstring()
+        report = account.report()
+        ops = report["operations"]
+        self.assertEqual(report["name"], "report")
+        self.assertEqual(ops["parse"]["calls"], 1)
+        self.assertEqual(ops["repeat"]["calls"], 3)
+        self.assertEqual(ops["content"]["calls"], 3)
+        self.assertEqual(ops["write"]["output_bytes"], len(out))
+        self.assertEqual(report["output_bytes"], len(out))
+        self.assertEqual(
+            report["nodes"], sum(op["nodes"] for op in ops.values())
+        )
+        self.assertGreater(report["estimated_bytes"], report["nodes"])
+
+    def test_write_xhtml_counted_once(self):
+        doc = parse_xmlstring(XML)
+        with RenderAccount() as account:
+            out = doc.write_xhtmlstring()
+        write = account.report()["operations"]["write"]
+        self.assertEqual(write["calls"], 1)
+        self.assertEqual(write["output_bytes"], len(out))
+
+    def test_write_to_filename(self):
+        doc = parse_xmlstring(XML)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "out.xml")
+            with RenderAccount() as account:
+                doc.write_xml(path)
+            with open(path, "rb") as fh:
+                out = fh.read()
+        write = account.report()["operations"]["write"]
+        self.assertEqual(write["calls"], 1)
+        self.assertEqual(write["output_bytes"], len(out))
+        self.assertEqual(out, doc.write_xmlstring())
+
+    def test_write_text(self):
+        doc = parse_xmlstring(XML)
+        doc.findmeld("c").content("\u00e9")
+        with RenderAccount() as account:
+            out = StringIO()
+            doc.write_xml(out, encoding="unicode", declaration=False)
+            html5 = doc.write_html5string(minify=True, encoding="unicode")
+        write = account.report()["operations"]["write"]
+        self.assertEqual(write["calls"], 2)
+        self.assertEqual(
+            write["output_bytes"],
+            len(out.getvalue().encode("utf-8")) + len(html5.encode("utf-8"))
+        )
+
+    def test_inactive(self):
+        account = RenderAccount()
+        parse_xmlstring(XML).clone()
+        self.assertEqual(account.nodes, 0)
+        with account:
+            pass
+        parse_xmlstring(XML)
+        self.assertEqual(account.nodes, 0)
+
+    def test_nested(self):
+        with RenderAccount() as outer:
+            with RenderAccount() as inner:
+                parse_xmlstring(XML)
+            parse_xmlstring(XML).clone()
+        self.assertEqual(inner.report()["operations"].keys(), {"parse"})
+        self.assertEqual(outer.nodes, inner.nodes * 3)
+
+    def test_node_limit(self):
+        doc = parse_xmlstring(XML)
+        with RenderAccount("big", max_nodes=20):
+            with self.assertRaises(RenderLimitExceeded) as cm:
+                for ele, data in doc.repeat(range(100), "r"):
+                    pass
+        self.assertIn("big", str(cm.exception))
+        self.assertIn("repeat", str(cm.exception))
+
+    def test_byte_limit(self):
+        with RenderAccount(max_bytes=1000):
+            self.assertRaises(
+                RenderLimitExceeded, parse_xmlstring,
+                "<a>" + "<b/>" * 100 + "</a>"
+            )
+
+    def test_python_tracing(self):
+        with RenderAccount(trace_python=True) as account:
+            keep = [parse_xmlstring(XML).clone() for i in range(100)]
+        self.assertGreater(account.report()["python_peak"], 0)
+        self.assertEqual(len(keep), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+from unittest import TestCase
+
+from benchmarks import bench
+
+
+class BenchmarkTests(TestCase):
+    def test_same_output(self):
+        # The baseline has to do the same work for the numbers to mean much
+        for name, (func, size) in bench.WORKLOADS.items():
+            self.assertEqual(
+                func(bench.IMPLEMENTATIONS["lxmlmeld"](), 25),
+                func(bench.IMPLEMENTATIONS["lxml"](), 25),
+                name
+            )
+
+    def test_run(self):
+        report = bench.run(
+            ["simple_fill", "table_10k"], ["lxmlmeld", "lxml"],
+            iterations=1, scale=0.001, isolate=False
+        )
+        self.assertIn("lxml", report["environment"])
+        self.assertEqual(len(report["results"]), 4)
+        for result in report["results"]:
+            self.assertGreater(result["renders_per_second"], 0)
+            self.assertGreater(result["output_bytes"], 0)
+            self.assertGreater(result["python_peak_bytes"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,11 @@
 import unittest
+from array import array
 from copy import deepcopy
+from decimal import Decimal
 from lxml.builder import E
 from unittest import TestCase
 
-from lxmlmeld import parse_xmlstring
+from lxmlmeld import Element, parse_xmlstring
 
 
 class ReplaceTests(TestCase):
@@ -122,6 +124,14 @@ class ContentTests(TestCase):
         replacements[1].tail = "!"
         self.as_expected(replacements, '<so completely="yes"/>-<awesome/>!')
 
+    def test_content_numbers(self):
+        self.as_expected(42, "42")
+        self.as_expected(1.5, "1.5")
+        self.as_expected(Decimal("3.10"), "3.10")
+
+    def test_content_formatter(self):
+        self.as_expected(1.5, "1.50", formatter="{:.2f}".format)
+
 
 class RepeatTests(TestCase):
     def as_expected(self, arg, expected_in_output):
@@ -172,6 +182,148 @@ class RepeatTests(TestCase):
     def test_repeat_multi(self):
         self.as_expected(['q', 'z'], '<bar a="q"/><bar a="z"/>')
 
+    def test_repeat_findmeld(self):
+        doc = parse_xmlstring(
+            "<a xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<r meld:id='r'><b><c meld:id='c'/></b><d meld:id='d'/></r></a>"
+        )
+        for ele, data in doc.repeat(['x', 'y'], 'r'):
+            ele.findmeld('c').content(data)
+            # Changing the structure of the row must not confuse findmeld
+            ele.insert(0, E("new"))
+            ele.findmeld('d').content(data)
+            self.assertEqual(ele.findmeld('r'), ele)
+            self.assertIsNone(ele.findmeld('missing'))
+        self.assertEqual(
+            doc.write_xmlstring(declaration=False),
+            b'<a><r><new/><b><c>x</c></b><d>x</d></r>'
+            b'<r><new/><b><c>y</c></b><d>y</d></r></a>'
+        )
+
+    def test_repeat_findmeld_original_position(self):
+        doc = parse_xmlstring(
+            "<a xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<r meld:id='r'><c meld:id='c'/><b meld:id='b'/></r></a>"
+        )
+        for ele, data in doc.repeat(['x'], 'r'):
+            b = ele.findmeld('b')
+            copy = b.clone()
+            ele.findmeld('c').append(copy)
+            # Found at its original position, although a search of the
+            # document would find the copy first
+            self.assertIs(ele.findmeld('b'), b)
+            self.assertIs(doc.findmeld('b'), copy)
+
+
+class RepeatTableTests(TestCase):
+    def test_repeat_table(self):
+        doc = parse_xmlstring(
+            "<t xmlns:meld='http://www.plope.com/software/meld3'>x"
+            "<tr meld:id='row'><td meld:id='a'/><td><i meld:id='b'>?</i></td>"
+            "</tr>y</t>"
+        )
+        doc.repeat_table(
+            {"a": ["1", "2"], "b": array("i", [3, 4])}, "row"
+        )
+        self.assertEqual(
+            doc.write_xmlstring(declaration=False),
+            b'<t>x<tr><td>1</td><td><i>3</i></td></tr>'
+            b'<tr><td>2</td><td><i>4</i></td></tr>y</t>'
+        )
+
+    def test_repeat_table_empty(self):
+        doc = parse_xmlstring(
+            "<t xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<tr meld:id='row'><td meld:id='a'/></tr></t>"
+        )
+        doc.repeat_table({"a": []}, "row")
+        self.assertEqual(doc.write_xmlstring(declaration=False), b'<t/>')
+
+    def test_repeat_table_errors(self):
+        doc = parse_xmlstring(
+            "<t xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<tr meld:id='row'><td meld:id='a'/></tr></t>"
+        )
+        self.assertRaises(
+            ValueError, doc.repeat_table, {"a": [1], "z": [1]}, "row"
+        )
+        self.assertRaises(
+            ValueError, doc.repeat_table, {"a": [1, 2], "row": [1]}, "row"
+        )
+
+
+class RepeatNestedTests(TestCase):
+    def test_repeat_nested(self):
+        doc = parse_xmlstring(
+            "<t xmlns:meld='http://www.plope.com/software/meld3'>x"
+            "<g meld:id='group'><h meld:id='name'/>a"
+            "<r meld:id='row'><c meld:id='cell'/></r>b</g>y</t>"
+        )
+        doc.repeat_nested([
+            {"name": "A", "row": [{"cell": 1}, {"cell": 2}]},
+            {"name": "B", "row": []},
+            {"name": "C"},
+        ], "group", ["row"])
+        self.assertEqual(
+            doc.write_xmlstring(declaration=False),
+            b'<t>x<g><h>A</h>a<r><c>1</c></r><r><c>2</c></r>b</g>'
+            b'<g><h>B</h>ab</g><g><h>C</h>ab</g>y</t>'
+        )
+
+    def test_repeat_nested_levels(self):
+        doc = parse_xmlstring(
+            "<t xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<a meld:id='a'><b meld:id='b'><c meld:id='c'/></b>"
+            "<d meld:id='d'/></a></t>"
+        )
+        doc.repeat_nested([
+            {"b": [{"c": [{}, {}]}, {"c": [{}]}], "d": [{}]},
+            {"b": [], "d": []},
+        ], "a", {"b": ["c"], "d": []})
+        self.assertEqual(
+            doc.write_xmlstring(declaration=False),
+            b'<t><a><b><c/><c/></b><b><c/></b><d/></a><a/></t>'
+        )
+
+    def test_repeat_nested_same_as_repeat(self):
+        src = (
+            "<t xmlns:meld='http://www.plope.com/software/meld3'>\n"
+            "<g meld:id='group'><h meld:id='name'/>\n"
+            " <r meld:id='row'><c meld:id='cell'/></r>\n</g>\n</t>"
+        )
+        groups = [("A", ["1", "2"]), ("B", []), ("C", ["3"])]
+        expected = parse_xmlstring(src)
+        for group, (name, cells) in expected.repeat(groups, "group"):
+            group.fillmelds(name=name)
+            for row, cell in group.repeat(cells, "row"):
+                row.fillmelds(cell=cell)
+        doc = parse_xmlstring(src)
+        doc.repeat_nested(
+            [
+                {"name": name, "row": [{"cell": cell} for cell in cells]}
+                for name, cells in groups
+            ],
+            "group", ["row"]
+        )
+        self.assertEqual(doc.write_xmlstring(), expected.write_xmlstring())
+
+    def test_repeat_nested_errors(self):
+        doc = parse_xmlstring(
+            "<t xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<g meld:id='group'><r meld:id='row'/></g></t>"
+        )
+        self.assertRaises(
+            ValueError, doc.repeat_nested, [{}], "group", ["missing"]
+        )
+        self.assertRaises(
+            ValueError, doc.repeat_nested, [{"z": 1}], "group", ["row"]
+        )
+        self.assertRaises(
+            ValueError, doc.repeat_nested, [{"row": [{"z": 1}]}], "group",
+            ["row"]
+        )
+        self.assertRaises(ValueError, doc.repeat_nested, [{}])
+
 
 class MeldFindingTests(TestCase):
     def test_findmeld_exists(self):
@@ -200,6 +352,46 @@ class MeldFindingTests(TestCase):
         found = doc.findmeld('z', '')
         self.assertEqual(found, '')
 
+    def test_findmeld_quotes(self):
+        doc = parse_xmlstring(
+            "<a xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<b meld:id=\"q'z\"/></a>"
+        )
+        self.assertEqual(doc.findmeld("q'z").tag, 'b')
+
+    def test_findmeld_after_changes(self):
+        doc = parse_xmlstring(
+            "<a xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<b meld:id='b'><c meld:id='c'/></b><d meld:id='d'/>"
+            "<e meld:id='e'/></a>"
+        )
+        doc.findmeld('b').content('gone')
+        self.assertIsNone(doc.findmeld('c'))
+        doc.findmeld('d').replace('gone')
+        self.assertIsNone(doc.findmeld('d'))
+        e = doc.findmeld('e')
+        doc.findmeld('b').append(e)
+        self.assertEqual(doc.findmeld('e'), e)
+        self.assertEqual(doc.findmeld('b').findmeld('e'), e)
+        self.assertIsNone(doc.findmeld('b').findmeld('a'))
+        new = E('f')
+        new.set('{http://www.plope.com/software/meld3}id', 'c')
+        doc.append(new)
+        self.assertEqual(doc.findmeld('c'), new)
+
+    def test_findmeld_after_insert_before(self):
+        doc = parse_xmlstring(
+            "<a xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<r meld:id='r'><c meld:id='c'/></r></a>"
+        )
+        r = doc.findmeld('r')
+        new = r.clone()
+        new.findmeld('c').content('filled')
+        r.addprevious(new)
+        # The first in document order is found, not the one found earlier
+        self.assertIs(doc.findmeld('r'), new)
+        self.assertEqual(doc.findmeld('c').text, 'filled')
+
     def test_meldid(self):
         doc = parse_xmlstring(
             "<a xmlns:meld='http://www.plope.com/software/meld3'>"
@@ -233,6 +425,54 @@ class FillMeldsTests(TestCase):
         )
         self.assertEqual(ret, ['a'])
 
+    def test_fill_melds_numbers(self):
+        doc = parse_xmlstring(
+            "<a xmlns:meld='http://www.plope.com/software/meld3'> "
+            "<b meld:id='z'><c/></b><b meld:id='q'/></a>"
+        )
+        doc.fillmelds(z=1, q=2.5)
+        self.assertEqual(
+            doc.write_xmlstring(declaration=False),
+            b'<a> <b>1</b><b>2.5</b></a>'
+        )
+
+    def test_fill_melds_class_formatter(self):
+        doc = parse_xmlstring(
+            "<a xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<b meld:id='b'/></a>"
+        )
+        # A plain function set on the class must not become a method
+        Element.formatter = lambda v: "%.2f" % v
+        try:
+            doc.fillmelds(b=1.5)
+        finally:
+            Element.formatter = staticmethod(str)
+        self.assertEqual(
+            doc.write_xmlstring(declaration=False), b'<a><b>1.50</b></a>'
+        )
+
+
+class FillColumnTests(TestCase):
+    def test_fill_column(self):
+        doc = parse_xmlstring(
+            "<a xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<r meld:id='r'><b meld:id='z'/></r></a>"
+        )
+        for ele, data in doc.repeat([1, 2, 3], 'r'):
+            pass
+        doc.fill_column('z', (x * 2 for x in range(3)))
+        self.assertEqual(
+            doc.write_xmlstring(declaration=False),
+            b'<a><r><b>0</b></r><r><b>2</b></r><r><b>4</b></r></a>'
+        )
+
+    def test_fill_column_mismatch(self):
+        doc = parse_xmlstring(
+            "<a xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<b meld:id='z'/></a>"
+        )
+        self.assertRaises(ValueError, doc.fill_column, 'z', [1, 2])
+
 
 class AttributesTests(TestCase):
     def test_fill_attributes(self):
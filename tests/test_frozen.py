@@ -0,0 +1,180 @@
+import sys
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree
+from lxml.builder import E
+from unittest import TestCase
+
+from lxmlmeld import Element, FrozenElement, FrozenError, parse_htmlstring, \
+    parse_xmlstring
+
+HTML = "<html><body><h1 meld:id='title'>Title</h1><table meld:id='table'>" \
+    "<tr meld:id='row'><td meld:id='name'>n</td><td meld:id='value'>v</td>" \
+    "</tr></table><p meld:id='footer' class='f'>footer</p></body></html>"
+XML = "<root xmlns:meld='http://www.plope.com/software/meld3' " \
+    "meld:id='root'>" + "".join(
+        "<item meld:id='i{0}' n='{0}'>text {0}<b>bold</b>tail</item>".format(i)
+        for i in range(100)
+    ) + "</root>"
+
+
+class FrozenTests(TestCase):
+    def setUp(self):
+        self.template = parse_htmlstring(HTML)
+        self.frozen = self.template.freeze()
+
+    def test_same_output(self):
+        for write in ("write_xmlstring", "write_xhtmlstring",
+                      "write_htmlstring"):
+            self.assertEqual(
+                getattr(self.frozen, write)(),
+                getattr(self.template, write)()
+            )
+        self.assertEqual(
+            self.frozen.write_htmlstring(parallel=2),
+            self.template.write_htmlstring()
+        )
+
+    def test_findmeld(self):
+        ele = self.frozen.findmeld("name")
+        self.assertIsInstance(ele, FrozenElement)
+        self.assertEqual(ele.text, "n")
+        self.assertIs(self.frozen.findmeld("name"), ele)
+        self.assertEqual(len(self.frozen.findmelds()), 6)
+        self.assertIsNone(self.frozen.findmeld("missing"))
+
+    def test_mutation_rejected(self):
+        ele = self.frozen.findmeld("footer")
+        for call in (
+            lambda: ele.content("x"),
+            lambda: ele.attributes(a="b"),
+            lambda: ele.replace("x"),
+            lambda: ele.deparent(),
+            lambda: self.frozen.fillmelds(title="x"),
+            lambda: self.frozen.repeat([1, 2], "row"),
+            lambda: self.frozen.repeat_table({"name": ["a"]}, "row"),
+            lambda: self.frozen.repeat_nested([{"name": "a"}], "row"),
+            lambda: self.frozen.fill_column("name", ["a"]),
+            lambda: ele.set("a", "b"),
+            lambda: ele.append(E("b")),
+            lambda: ele.addnext(E("b")),
+            lambda: ele.clear(),
+            lambda: setattr(ele, "text", "x"),
+            lambda: setattr(ele, "tail", "x"),
+            lambda: setattr(ele, "tag", "x"),
+            lambda: setattr(ele, "base", "x"),
+            lambda: ele.getparent().remove(ele),
+        ):
+            self.assertRaises(FrozenError, call)
+        with self.assertRaises(TypeError):
+            ele.attrib["a"] = "b"
+        self.assertEqual(ele.attrib["class"], "f")
+        self.assertEqual(
+            self.frozen.write_htmlstring(), self.template.write_htmlstring()
+        )
+
+    def test_clone(self):
+        for ele in (self.frozen, self.frozen.findmeld("table")):
+            copy = ele.clone()
+            self.assertNotIsInstance(copy, FrozenElement)
+            self.assertIsInstance(copy, Element)
+            for row, data in copy.repeat(["a", "b"], "row"):
+                row.fillmelds(name=data, value=data.upper())
+            self.assertIn(b"<td>b</td><td>B</td>", copy.write_htmlstring())
+        self.assertNotIn(b"<td>a</td>", self.frozen.write_htmlstring())
+
+    def test_output_from_frozen_tree(self):
+        # What is written is the frozen tree itself, not a copy kept aside
+        # (lxml's module-level functions aren't stopped)
+        etree.SubElement(self.frozen.findmeld("footer"), "b")
+        self.assertIn(b"<b></b></p>", self.frozen.write_htmlstring())
+        self.assertIn(b"<b></b></p>", self.frozen.clone().write_htmlstring())
+
+    def test_original_unaffected(self):
+        self.template.fillmelds(title="changed")
+        self.assertEqual(self.frozen.findmeld("title").text, "Title")
+        self.assertEqual(self.template.findmeld("title").text, "changed")
+
+
+class StressTests(TestCase):
+    # Hammers one frozen tree from many threads at once, checking that every
+    # result is the same as from a single thread
+    THREADS = 16
+    TASKS = 400
+
+    def setUp(self):
+        self.switch = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch)
+
+    def run_tasks(self, frozen, task):
+        start = threading.Barrier(self.THREADS)
+
+        def wait_then(n):
+            if n < self.THREADS:
+                start.wait()
+            return task(n)
+
+        with ThreadPoolExecutor(self.THREADS) as pool:
+            return list(pool.map(wait_then, range(self.TASKS)))
+
+    def test_concurrent_reads(self):
+        frozen = parse_xmlstring(XML).freeze()
+        expected = {
+            "xml": frozen.write_xmlstring(),
+            "html": frozen.write_htmlstring(),
+            "xhtml": frozen.write_xhtmlstring(),
+            "pipeline": frozen.write_xmlstring(pipeline=True),
+        }
+
+        def task(n):
+            ele = frozen.findmeld("i{}".format(n % 100))
+            assert ele.get("n") == str(n % 100), ele.get("n")
+            assert len(frozen.findmelds()) == 101
+            assert ele.findmeld("i{}".format(n % 100)) is ele
+            kind = ("xml", "html", "xhtml", "pipeline")[n % 4]
+            if kind == "pipeline":
+                return kind, frozen.write_xmlstring(pipeline=True)
+            return kind, getattr(frozen, "write_{}string".format(kind))()
+
+        for kind, result in self.run_tasks(frozen, task):
+            self.assertEqual(result, expected[kind])
+
+    def test_concurrent_renders(self):
+        frozen = parse_htmlstring(HTML).freeze()
+
+        def task(n):
+            doc = frozen.clone()
+            doc.fillmelds(title="Render {}".format(n))
+            doc.findmeld("table").repeat_table(
+                {"name": range(n % 7), "value": range(n, n + n % 7)}, "row"
+            )
+            return n, doc.write_htmlstring(fragment=True)
+
+        for n, result in self.run_tasks(frozen, task):
+            doc = parse_htmlstring(HTML)
+            doc.fillmelds(title="Render {}".format(n))
+            doc.findmeld("table").repeat_table(
+                {"name": range(n % 7), "value": range(n, n + n % 7)}, "row"
+            )
+            self.assertEqual(result, doc.write_htmlstring(fragment=True))
+        self.assertEqual(
+            frozen.write_htmlstring(),
+            parse_htmlstring(HTML).write_htmlstring()
+        )
+
+    def test_concurrent_parallel_writes(self):
+        frozen = parse_xmlstring(XML).freeze()
+        expected = frozen.write_xmlstring()
+        with ThreadPoolExecutor(4) as inner:
+            results = self.run_tasks(
+                frozen, lambda n: frozen.write_xmlstring(parallel=inner)
+            )
+        self.assertEqual(results, [expected] * self.TASKS)
+
+
+if __name__ == '__main__':
+    unittest.main()
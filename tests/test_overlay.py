@@ -0,0 +1,180 @@
+import gzip
+import unittest
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree
+from lxml.builder import E
+from unittest import TestCase
+
+from lxmlmeld import Element, parse_htmlstring, parse_xmlstring
+from lxmlmeld.overlay import OverlayTemplate
+
+HTML = "<html meld:id='root'><body meld:id='body'>pre<p meld:id='p' " \
+    "class='c'>old<i meld:id='i'>in</i>t</p>tail<img meld:id='img' " \
+    "src='a'>after<table><tr><td meld:id='td'></td></tr></table>" \
+    "<script meld:id='s'>x</script></body></html>"
+XHTML = '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" ' \
+    '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">' \
+    "<html xmlns='http://www.w3.org/1999/xhtml' " \
+    "xmlns:meld='http://www.plope.com/software/meld3' meld:id='root'>" \
+    "<head/><body meld:id='body'>pre<p meld:id='p' class='c'>old" \
+    "<i meld:id='i'>in</i>t</p>tail<img meld:id='img' src='a'/>after" \
+    "<td meld:id='td'/><br/><script meld:id='s'>x</script></body></html>"
+
+CHANGES = [
+    [],
+    [("content", "p", "<new> & é")],
+    [("content", "i", 5)],
+    [("attributes", "p", {"class": "z&\"<"})],
+    [("attributes", "img", {"src": "b"})],
+    [("content", "td", "cell")],
+    [("attributes", "td", {"x": "1"}), ("content", "td", "c")],
+    [("replace", "p", "r<>")],
+    [("replace", "i", lambda: E("b", "bold"))],
+    [("content", "body", "<x>y</x>z", True)],
+    [("attributes", "root", {"lang": "en"})],
+    [("attributes", "i", {"k": "v"}), ("content", "p", "outer")],
+    [("content", "s", "a<b")],
+    [("content", "p", None)],
+    [("content", "p", ""), ("attributes", "p", {"k": "v"})],
+    [("content", "img", "")],
+    [("content", "img", None)],
+    [("content", "td", "")],
+    [("content", "i", "x"), ("content", "p", "", True)],
+    [("content", "body", None)],
+    [("content", "root", "")],
+]
+
+
+def _apply(target, change, overlay):
+    kind, name, value = change[:3]
+    if callable(value):
+        value = value()
+    if kind == "attributes":
+        if overlay:
+            target.attributes(name, **value)
+        else:
+            target.findmeld(name).attributes(**value)
+        return
+    structure = len(change) > 3
+    if overlay:
+        getattr(target, kind)(name, value, structure=structure)
+    else:
+        getattr(target.findmeld(name), kind)(value, structure=structure)
+
+
+class OverlayTemplateTests(TestCase):
+    def check(self, root, method, **kwargs):
+        template = OverlayTemplate(root, method, **kwargs)
+        write = "write_{}string".format(method)
+        for changes in CHANGES:
+            doc = root.clone()
+            overlay = template.overlay()
+            for change in changes:
+                _apply(doc, change, False)
+                _apply(overlay, change, True)
+            self.assertEqual(
+                overlay.write(), getattr(doc, write)(**kwargs), changes
+            )
+
+    def test_html(self):
+        self.check(parse_htmlstring(HTML), "html")
+        self.check(parse_htmlstring(HTML), "html", encoding="UTF-8")
+        self.check(parse_htmlstring(HTML), "xml")
+
+    def test_xhtml(self):
+        self.check(parse_xmlstring(XHTML), "xhtml")
+        self.check(parse_xmlstring(XHTML), "xml", encoding="UTF-8")
+        self.check(parse_xmlstring(XHTML), "html")
+
+    def test_template_unchanged(self):
+        root = parse_htmlstring(HTML)
+        before = root.write_htmlstring()
+        overlay = OverlayTemplate(root).overlay()
+        overlay.content("p", "new")
+        overlay.replace("img", "gone")
+        overlay.write()
+        self.assertEqual(root.write_htmlstring(), before)
+
+    def test_empty_root(self):
+        root = parse_xmlstring(
+            "<a xmlns:meld='http://www.plope.com/software/meld3' "
+            "meld:id='a'/>"
+        )
+        overlay = OverlayTemplate(root, "xml", declaration=False).overlay()
+        overlay.content("a", "x")
+        self.assertEqual(overlay.write(), b"<a>x</a>")
+
+    def test_errors(self):
+        overlay = OverlayTemplate(parse_htmlstring(HTML)).overlay()
+        self.assertRaises(KeyError, overlay.content, "missing", "x")
+        self.assertRaises(ValueError, overlay.replace, "root", "x")
+        self.assertEqual(overlay.fillmelds(p="x", missing="y"), ["missing"])
+        self.assertRaises(
+            ValueError, OverlayTemplate, parse_htmlstring(HTML),
+            encoding="UTF-16"
+        )
+        for method in ("html5", "text"):
+            self.assertRaises(
+                ValueError, OverlayTemplate, parse_htmlstring(HTML), method
+            )
+
+    def test_formatter(self):
+        class Formatted(Element):
+            formatter = staticmethod("{:.2f}".format)
+
+        parser = etree.XMLParser()
+        parser.set_element_class_lookup(
+            etree.ElementDefaultClassLookup(element=Formatted)
+        )
+        root = etree.fromstring(XHTML, parser)
+        overlay = OverlayTemplate(root, "xhtml").overlay()
+        overlay.content("p", 1.5)
+        overlay.content("td", 2, formatter=hex)
+        output = overlay.write()
+        self.assertIn(b">1.50</p>", output)
+        self.assertIn(b">0x2</td>", output)
+
+    def test_write_sinks(self):
+        overlay = OverlayTemplate(parse_htmlstring(HTML)).overlay()
+        overlay.content("p", "new")
+        expected = overlay.write()
+        out = bytearray()
+        self.assertEqual(overlay.write(out), len(expected))
+        self.assertEqual(bytes(out), expected)
+        self.assertEqual(b"".join(overlay.chunks()), expected)
+
+    def test_compressed(self):
+        template = OverlayTemplate(parse_htmlstring(HTML))
+        for changes in CHANGES:
+            overlay = template.overlay()
+            for change in changes:
+                _apply(overlay, change, True)
+            expected = overlay.write()
+            self.assertEqual(
+                gzip.decompress(overlay.write(compress="gzip")), expected
+            )
+            chunks = overlay.compressed_chunks("deflate")
+            self.assertEqual(zlib.decompress(b"".join(chunks)), expected)
+            self.assertEqual(
+                zlib.decompress(overlay.write(compress=zlib.compressobj)),
+                expected
+            )
+
+    def test_threads(self):
+        template = OverlayTemplate(parse_htmlstring(HTML))
+
+        def render(n):
+            overlay = template.overlay()
+            overlay.fillmelds(p=n, td="cell {}".format(n))
+            return overlay.write()
+
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(render, range(200)))
+        for n, result in enumerate(results):
+            self.assertIn("<p class=\"c\">{}</p>".format(n).encode(), result)
+            self.assertIn("<td>cell {}</td>".format(n).encode(), result)
+
+
+if __name__ == '__main__':
+    unittest.main()
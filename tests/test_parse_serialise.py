@@ -1,8 +1,15 @@
+import asyncio
+import gzip
+import os
+import tempfile
 import unittest
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO, StringIO
-from unittest import TestCase
+from unittest import TestCase, mock
 
-from lxmlmeld import parse_xml, parse_xmlstring, parse_html, parse_htmlstring
+from lxmlmeld import MeldParser, parse_async, parse_chunks, parse_html, \
+    parse_htmlstring, parse_xml, parse_xmlstring
 
 
 class XMLTests(TestCase):
@@ -266,5 +273,329 @@ class XHTMLTests(TestCase):
                 self.assertIn(b"<br /><p></p></body></html>", txt)
 
 
+class HTML5Tests(TestCase):
+    HTML = "<html>\n <head><title>T &amp; \u00e9</title>" \
+        "<script>if (a < b) {}</script></head>\n <body>\n" \
+        "  <div class='a b' id='main' data-x='' title='say \"hi\"'>\n" \
+        "   <p meld:id='p'>Hello   <b>big</b>  <i>world</i>\n   </p>\n" \
+        "   <video><source src='a.mp4'><track kind=captions></video>\n" \
+        "   <pre>  keep\n this </pre><input type=checkbox checked>\n" \
+        "   <p>word<wbr>break<br></p>\n  </div>\n </body>\n</html>"
+
+    def test_void_elements(self):
+        doc = parse_htmlstring(self.HTML)
+        out = doc.write_html5string()
+        self.assertTrue(out.startswith(b"<!DOCTYPE html>\n<html>"))
+        self.assertIn(
+            b'<video><source src="a.mp4"><track kind="captions"></video>',
+            out
+        )
+        self.assertIn(b"<p>word<wbr>break<br></p>", out)
+        self.assertIn(b"T &amp; &#233;", out)
+        self.assertIn(b"<script>if (a < b) {}</script>", out)
+        self.assertNotIn(b"meld", out)
+
+    def test_same_as_html(self):
+        doc = parse_htmlstring("<html><body><p>\u00e9</p><br></body></html>")
+        for kwargs in ({}, {"encoding": "UTF-8"}, {"fragment": True}):
+            self.assertEqual(
+                doc.write_html5string(**kwargs),
+                doc.write_htmlstring(doctype="<!DOCTYPE html>", **kwargs)
+            )
+        self.assertEqual(
+            doc.write_html5string(encoding="unicode", fragment=True),
+            "<html><body><p>\u00e9</p><br></body></html>"
+        )
+
+    def test_minify(self):
+        doc = parse_htmlstring(self.HTML)
+        self.assertEqual(
+            doc.write_html5string(minify=True, encoding="UTF-8"),
+            "<!DOCTYPE html><html><head><title>T &amp; \u00e9</title>"
+            "<script>if (a < b) {}</script></head><body>"
+            "<div class=\"a b\" id=main data-x title=\"say &quot;hi&quot;\">"
+            "<p>Hello <b>big</b> <i>world</i></p>"
+            "<video><source src=a.mp4><track kind=captions></video>"
+            "<pre>  keep\n this </pre><input type=checkbox checked>"
+            "<p>word<wbr>break<br></p></div></body></html>".encode("utf-8")
+        )
+        self.assertIn(
+            b"T &amp; &#233;", doc.write_html5string(minify=True)
+        )
+
+    def test_minify_keeps_inline_whitespace(self):
+        doc = parse_htmlstring(
+            "<html><body><p><b>Hello</b> <font color=red>world</font> "
+            "<tt>a</tt>\n<my-el>b</my-el> <nobr>c</nobr></p>\n"
+            "<div> <my-el>d</my-el> </div></body></html>"
+        )
+        self.assertEqual(
+            doc.write_html5string(minify=True, fragment=True),
+            b"<html><body><p><b>Hello</b> <font color=red>world</font> "
+            b"<tt>a</tt> <my-el>b</my-el> <nobr>c</nobr></p>"
+            b"<div><my-el>d</my-el></div></body></html>"
+        )
+
+    def test_write_handle(self):
+        doc = parse_htmlstring(self.HTML)
+        for minify in (False, True):
+            io = BytesIO()
+            doc.write_html5(io, minify=minify)
+            self.assertEqual(
+                io.getvalue(), doc.write_html5string(minify=minify)
+            )
+            self.assertEqual(
+                b"".join(doc.write_html5chunks(minify=minify)),
+                io.getvalue()
+            )
+
+    def test_xhtml_namespace(self):
+        doc = parse_xmlstring(
+            "<html xmlns='http://www.w3.org/1999/xhtml' "
+            "xmlns:meld='http://www.plope.com/software/meld3'><body>"
+            "<p meld:id='p'>a<br/>b<img src='x'/><wbr/></p></body></html>"
+        )
+        self.assertEqual(
+            doc.write_html5string(),
+            b'<!DOCTYPE html>\n<html><body><p>a<br>b<img src="x"><wbr>'
+            b'</p></body></html>'
+        )
+        self.assertEqual(
+            doc.write_html5string(minify=True),
+            b'<!DOCTYPE html><html><body><p>a<br>b<img src=x><wbr>'
+            b'</p></body></html>'
+        )
+
+    def test_streamed(self):
+        doc = parse_htmlstring(
+            "<html><body>" + "<p>x<wbr>y</p>" * 2000 + "</body></html>"
+        )
+        chunks = doc.write_html5chunks()
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(
+            b"".join(chunks),
+            b"<!DOCTYPE html>\n<html><body>" + b"<p>x<wbr>y</p>" * 2000 +
+            b"</body></html>"
+        )
+
+
+class BufferOutputTests(TestCase):
+    def setUp(self):
+        self.doc = parse_xmlstring(
+            "<a xmlns:meld='http://www.plope.com/software/meld3'>" +
+            "<b meld:id='b'>x&amp;y</b>" + "<c>z</c>" * 2000 + "</a>"
+        )
+
+    def test_chunks(self):
+        for method in ("xml", "xhtml", "html"):
+            expected = getattr(self.doc, "write_{}string".format(method))()
+            chunks = getattr(self.doc, "write_{}chunks".format(method))()
+            self.assertEqual(b"".join(chunks), expected)
+        chunks = self.doc.write_xmlchunks()
+        self.assertGreater(len(chunks), 1)
+        self.assertIsInstance(chunks[0], bytes)
+
+    def test_bytearray(self):
+        buf = bytearray(b"<list>")
+        written = self.doc.write_xml(buf, fragment=True)
+        self.doc.write_xml(buf, fragment=True)
+        buf += b"</list>"
+        fragment = self.doc.write_xmlstring(fragment=True)
+        self.assertEqual(written, len(fragment))
+        self.assertEqual(bytes(buf), b"<list>" + fragment * 2 + b"</list>")
+
+    def test_memoryview(self):
+        expected = self.doc.write_htmlstring()
+        buf = bytearray(len(expected) + 10)
+        written = self.doc.write_html(memoryview(buf))
+        self.assertEqual(written, len(expected))
+        self.assertEqual(bytes(buf[:written]), expected)
+        self.assertRaises(
+            ValueError, self.doc.write_html, memoryview(bytearray(10))
+        )
+
+    def test_filename(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            name = os.path.join(tmp, "out.xml")
+            self.doc.write_xml(name, encoding="UTF-8")
+            with open(name, "rb") as fh:
+                self.assertEqual(
+                    fh.read(), self.doc.write_xmlstring(encoding="UTF-8")
+                )
+
+    def test_unicode(self):
+        io = StringIO()
+        self.doc.write_xml(io, encoding="unicode", declaration=False)
+        self.assertEqual(
+            io.getvalue(), self.doc.write_xmlstring(encoding="unicode",
+                                                    declaration=False)
+        )
+
+
+class CompressionTests(TestCase):
+    def setUp(self):
+        self.doc = parse_htmlstring(
+            "<html><body><p meld:id='p'>x</p>" + "<p>y</p>" * 2000 +
+            "</body></html>"
+        )
+
+    def test_formats(self):
+        for method in ("xml", "xhtml", "html", "html5"):
+            write = getattr(self.doc, "write_{}string".format(method))
+            expected = write()
+            self.assertEqual(gzip.decompress(write(compress="gzip")), expected)
+            self.assertEqual(
+                zlib.decompress(write(compress="deflate")), expected
+            )
+        self.assertEqual(
+            gzip.decompress(
+                self.doc.write_htmlstring(compress="gzip", parallel=2)
+            ),
+            self.doc.write_htmlstring()
+        )
+
+    def test_sinks(self):
+        expected = self.doc.write_htmlstring()
+        buf = bytearray()
+        written = self.doc.write_html(buf, compress="gzip")
+        self.assertEqual(written, len(buf))
+        self.assertEqual(gzip.decompress(bytes(buf)), expected)
+        io = BytesIO()
+        self.assertIsNone(self.doc.write_html(io, compress="deflate"))
+        self.assertEqual(zlib.decompress(io.getvalue()), expected)
+        chunks = self.doc.write_htmlchunks(compress="gzip")
+        self.assertEqual(gzip.decompress(b"".join(chunks)), expected)
+        with tempfile.TemporaryDirectory() as tmp:
+            name = os.path.join(tmp, "out.html.gz")
+            self.doc.write_html(name, compress="gzip")
+            with gzip.open(name) as fh:
+                self.assertEqual(fh.read(), expected)
+
+    def test_custom_compressor(self):
+        out = self.doc.write_html5string(
+            compress=lambda: zlib.compressobj(9), minify=True
+        )
+        self.assertEqual(
+            zlib.decompress(out), self.doc.write_html5string(minify=True)
+        )
+
+    def test_errors(self):
+        self.assertRaises(
+            ValueError, self.doc.write_htmlstring, compress="unknown"
+        )
+        self.assertRaises(
+            ValueError, self.doc.write_htmlstring, compress="gzip",
+            encoding="unicode"
+        )
+
+
+class ParallelTests(TestCase):
+    XML = "<r xmlns='urn:r' xmlns:q='urn:q' xmlns:unused='urn:u' " \
+        "xmlns:meld='http://www.plope.com/software/meld3'>start" \
+        "<q:a q:b='1' meld:id='a'>x</q:a>a-tail<meld:gone/>" \
+        "<c meld:id='c'><d>1</d>d<d>2</d>e<d>3</d>f</c>" + \
+        "<e>&lt;&amp;</e>tail" * 20 + "</r>"
+
+    def check(self, doc, method, **kwargs):
+        write = getattr(doc, "write_{}string".format(method))
+        before = doc.write_xmlstring(pipeline=True)
+        expected = write()
+        for parallel in (1, 3, True, ThreadPoolExecutor(2)):
+            self.assertEqual(write(parallel=parallel, **kwargs), expected)
+        self.assertEqual(doc.write_xmlstring(pipeline=True), before)
+
+    def test_xml(self):
+        doc = parse_xmlstring(self.XML)
+        self.check(doc, "xml")
+        self.check(doc, "xml", split="c")
+        self.assertRaises(
+            ValueError, doc.write_xmlstring, parallel=2, split="nope"
+        )
+        self.assertEqual(
+            doc.write_xmlstring(encoding="UTF-16", parallel=2),
+            doc.write_xmlstring(encoding="UTF-16")
+        )
+
+    def test_html(self):
+        doc = parse_htmlstring(
+            "<html><body><table><tbody meld:id='t'>x<tr meld:id='r'>"
+            "<td meld:id='c'>x</td></tr>y</tbody></table><br></body></html>"
+        )
+        for ele, data in doc.repeat(range(50), "r"):
+            ele.findmeld("c").content(data)
+        self.check(doc, "html")
+        self.check(doc, "html", split="t")
+
+    def test_xhtml(self):
+        doc = parse_xmlstring(
+            XHTMLTests.DT + "<html xmlns='http://www.w3.org/1999/xhtml' "
+            "xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<head/><body meld:id='b'><br/><p/></body></html>"
+        )
+        self.check(doc, "xhtml")
+
+    def test_one_thread_per_cpu(self):
+        doc = parse_xmlstring(self.XML)
+        pools = []
+
+        class Pool(ThreadPoolExecutor):
+            def __init__(self, workers):
+                pools.append(workers)
+                super().__init__(workers)
+
+        with mock.patch("concurrent.futures.ThreadPoolExecutor", Pool), \
+                mock.patch("os.cpu_count", return_value=3):
+            out = doc.write_xmlstring(parallel=True)
+        self.assertEqual(pools, [3])
+        self.assertEqual(out, doc.write_xmlstring())
+
+    def test_write_handle(self):
+        doc = parse_xmlstring(self.XML)
+        io = BytesIO()
+        doc.write_xml(io, parallel=2)
+        self.assertEqual(io.getvalue(), doc.write_xmlstring())
+        buf = bytearray()
+        doc.write_xml(buf, parallel=2, split="c")
+        self.assertEqual(bytes(buf), doc.write_xmlstring())
+
+
+class FeedParserTests(TestCase):
+    HTML = "<html><body><p meld:id='a'>x</p><br><p meld:id='b'>y</p>" \
+        "</body></html>"
+
+    def test_feed_html(self):
+        parser = MeldParser(html=True)
+        for i in range(0, len(self.HTML), 7):
+            parser.feed(self.HTML[i:i + 7])
+        doc = parser.close()
+        self.assertEqual(doc.findmeld("b").text, "y")
+        self.assertEqual(
+            doc.write_htmlstring(),
+            parse_htmlstring(self.HTML).write_htmlstring()
+        )
+
+    def test_feed_xml(self):
+        xml = b"<a xmlns:meld='http://www.plope.com/software/meld3'>" \
+            b"<b meld:id='b'/></a>"
+        doc = parse_chunks([xml[:10], xml[10:30], xml[30:]])
+        self.assertEqual(doc.findmeld("b").tag, "b")
+        self.assertEqual(
+            doc.write_xmlstring(declaration=False), b"<a><b/></a>"
+        )
+
+    def test_duplicate_found_early(self):
+        parser = MeldParser(html=True)
+        parser.feed("<html><body><p meld:id='a'>x</p>")
+        self.assertRaises(ValueError, parser.feed, "<p meld:id='a'>")
+
+    def test_async(self):
+        async def chunks():
+            yield "<html><body><p meld:id"
+            yield "='a'>x</p></body></html>"
+
+        doc = asyncio.run(parse_async(chunks(), html=True))
+        self.assertEqual(doc.findmeld("a").text, "x")
+
+
 if __name__ == '__main__':
     unittest.main()
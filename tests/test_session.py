@@ -0,0 +1,87 @@
+import unittest
+from lxml.builder import E
+from unittest import TestCase
+
+from lxmlmeld import parse_htmlstring
+from lxmlmeld.session import RenderSession
+
+
+class RenderSessionTests(TestCase):
+    def setUp(self):
+        self.session = RenderSession(parse_htmlstring(
+            "<html><body><div meld:id='outer'><p meld:id='a'>a</p>"
+            "<p meld:id='b' class='x'>b</p></div><p meld:id='c'>c</p>"
+            "<p meld:id='d'>d</p>tail</body></html>"
+        ))
+
+    def test_render_then_patch(self):
+        self.assertIn(b"<p>a</p>", self.session.render(fragment=True))
+        self.assertEqual(self.session.patches(), [])
+        self.session.content("a", "<new>")
+        self.session.attributes("b", **{"class": "y"})
+        self.assertEqual(self.session.patches(), [
+            ("a", b"<p>&lt;new&gt;</p>"),
+            ("b", b'<p class="y">b</p>'),
+        ])
+        self.assertEqual(self.session.patches(), [])
+
+    def test_unchanged_values_skipped(self):
+        self.session.content("a", "a")
+        self.session.attributes("b", **{"class": "x"})
+        self.assertEqual(self.session.fillmelds(c="c", z="q"), ["z"])
+        self.assertEqual(self.session.patches(), [])
+
+    def test_outer_meld_wins(self):
+        self.session.content("a", "new")
+        self.session.attributes("outer", id="o")
+        self.assertEqual(self.session.patches(), [
+            ("outer", b'<div id="o"><p>new</p><p class="x">b</p></div>'),
+        ])
+
+    def test_detached_meld_skipped(self):
+        self.session.content("a", "new")
+        self.session.content("outer", "x")
+        self.assertEqual(self.session.patches(), [
+            ("outer", b"<div>x</div>"),
+        ])
+
+    def test_replace(self):
+        self.session.replace("c", "<x>")
+        self.session.replace("d", E("b", "bold"))
+        self.assertEqual(self.session.patches(), [
+            ("c", b"&lt;x&gt;"),
+            ("d", b"<b>bold</b>"),
+        ])
+        self.assertIn(
+            b"&lt;x&gt;<b>bold</b>tail", self.session.render(fragment=True)
+        )
+        self.assertRaises(KeyError, self.session.content, "c", "q")
+
+    def test_replace_structure(self):
+        self.session.replace("c", "t<i>x</i>u", structure=True)
+        self.assertEqual(self.session.patches(), [("c", b"t<i>x</i>u")])
+
+    def test_methods(self):
+        for method, br in (("xml", b"<br/>"), ("xhtml", b"<br />"),
+                           ("html", b"<br>"), ("html5", b"<br>")):
+            session = RenderSession(
+                parse_htmlstring(
+                    "<html><body><p meld:id='a'>a<br></p>"
+                    "<p meld:id='c'>c</p></body></html>"
+                ),
+                method=method
+            )
+            self.assertIn(br, session.render(fragment=True))
+            session.attributes("a", id="x")
+            session.replace("c", "<i>r</i><br/>", structure=True)
+            self.assertEqual(session.patches(), [
+                ("a", b'<p id="x">a' + br + b"</p>"),
+                ("c", b"<i>r</i>" + br),
+            ], method)
+        self.assertRaises(
+            ValueError, RenderSession, parse_htmlstring("<p/>"), "text"
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+import unittest
+from io import StringIO
+from unittest import TestCase
+
+import lxmlmeld
+
+# Generous limits: these catch regressions such as doing real work at import
+# time, not small changes in speed.
+IMPORT_LIMIT = 2.0
+FIRST_RENDER_LIMIT = 0.2
+
+TIMER = """
+import sys, time
+t = time.perf_counter()
+import lxmlmeld
+t1 = time.perf_counter()
+if sys.argv[1] == 'warm':
+    lxmlmeld.warmup()
+t2 = time.perf_counter()
+doc = lxmlmeld.parse_htmlstring(
+    "<html><body><p meld:id='p'>x</p></body></html>"
+)
+doc.fillmelds(p="y")
+doc.write_htmlstring()
+t3 = time.perf_counter()
+print(t1 - t, t3 - t2)
+"""
+
+
+def _time(mode):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.check_output(
+        [sys.executable, "-c", TIMER, mode], cwd=root
+    )
+    return [float(t) for t in out.split()]
+
+
+class StartupTests(TestCase):
+    def test_import_and_first_render(self):
+        import_time, render_time = _time("cold")
+        self.assertLess(import_time, IMPORT_LIMIT)
+        self.assertLess(render_time, FIRST_RENDER_LIMIT)
+
+    def test_warm_first_render(self):
+        import_time, render_time = _time("warm")
+        self.assertLess(render_time, FIRST_RENDER_LIMIT)
+
+
+class WarmupTests(TestCase):
+    def test_warmup(self):
+        self.assertEqual(lxmlmeld.warmup(), [])
+
+    def test_warmup_templates(self):
+        docs = lxmlmeld.warmup([
+            "<a xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<b meld:id='b'/></a>",
+            StringIO("<c/>"),
+        ])
+        self.assertEqual([d.tag for d in docs], ["a", "c"])
+        self.assertEqual(docs[0].findmeld("b").tag, "b")
+
+    def test_warmup_html_templates(self):
+        docs = lxmlmeld.warmup(["<p meld:id='p'>x</p>"], html=True)
+        self.assertEqual(docs[0].findmeld("p").tag, "p")
+
+
+if __name__ == '__main__':
+    unittest.main()
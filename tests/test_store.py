@@ -0,0 +1,101 @@
+import multiprocessing
+import unittest
+from io import StringIO
+from unittest import TestCase
+
+from lxmlmeld.store import TemplateStore
+
+XML = "<a xmlns:meld='http://www.plope.com/software/meld3'>" \
+    "<b meld:id='b'>x</b></a>"
+HTML = "<html><body><p meld:id='p'>x</p><br></body></html>"
+
+
+def _render(store, queue):
+    doc = store.get("html")
+    doc.fillmelds(p="child")
+    queue.put(doc.write_htmlstring(fragment=True))
+
+
+class TemplateStoreTests(TestCase):
+    def check(self, store):
+        doc = store.get("xml")
+        doc.fillmelds(b="filled")
+        self.assertEqual(
+            doc.write_xmlstring(declaration=False), b"<a><b>filled</b></a>"
+        )
+        self.assertEqual(
+            store.get("xml").write_xmlstring(declaration=False),
+            b"<a><b>x</b></a>"
+        )
+        doc = store.get("html")
+        doc.fillmelds(p="filled")
+        self.assertEqual(
+            doc.write_htmlstring(fragment=True),
+            b"<html><body><p>filled</p><br></body></html>"
+        )
+        self.assertEqual(sorted(store.names()), ["html", "xml"])
+        self.assertRaises(KeyError, store.get, "missing")
+
+    def test_store(self):
+        store = TemplateStore()
+        store.add_xml("xml", XML)
+        store.add_html("html", StringIO(HTML))
+        self.check(store)
+
+    def test_shared_store(self):
+        store = TemplateStore(shared=True)
+        store.add_xml("xml", StringIO(XML))
+        store.add_html("html", HTML)
+        store.share()
+        try:
+            self.check(store)
+            self.assertRaises(ValueError, store.add_xml, "other", XML)
+        finally:
+            store.close()
+
+    def test_html_with_svg(self):
+        store = TemplateStore()
+        store.add_html(
+            "svg", "<html><body><p meld:id='p'>\u00e9</p><svg>"
+            "<use xlink:href='#a'/></svg><script>a<b</script></body></html>"
+        )
+        doc = store.get("svg")
+        doc.fillmelds(p="filled")
+        self.assertEqual(
+            doc.write_htmlstring(fragment=True, encoding="UTF-8"),
+            b'<html><body><p>filled</p><svg><use xlink:href="#a"></use>'
+            b'</svg><script>a<b</script></body></html>'
+        )
+        self.assertEqual(store.get("svg").findmeld("p").text, "\u00e9")
+
+    def test_bad_template(self):
+        store = TemplateStore()
+        self.assertRaises(
+            ValueError, store.add_xml, "bad",
+            "<a xmlns:meld='http://www.plope.com/software/meld3'>"
+            "<b meld:id='b'/><c meld:id='b'/></a>"
+        )
+
+    @unittest.skipUnless(
+        "fork" in multiprocessing.get_all_start_methods(), "needs fork"
+    )
+    def test_forked_worker(self):
+        store = TemplateStore(shared=True)
+        store.add_html("html", HTML)
+        store.share()
+        try:
+            ctx = multiprocessing.get_context("fork")
+            queue = ctx.Queue()
+            proc = ctx.Process(target=_render, args=(store, queue))
+            proc.start()
+            result = queue.get(timeout=10)
+            proc.join()
+            self.assertEqual(
+                result, b"<html><body><p>child</p><br></body></html>"
+            )
+        finally:
+            store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()